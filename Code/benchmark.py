@@ -0,0 +1,293 @@
+# benchmarks of the transformations in transforms.py on synthetic Morrisville, Cary and weather data. No database, AWS
+# access or environment variables are needed, e.g.: python benchmark.py --sizes 10000 100000 --stages clean_raw map_cary
+# With --cold-start the import time of the lambda functions and the first call of the transformations are measured instead.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import transforms
+
+
+# number of rows of the synthetic datasets
+SIZES = [10000, 100000, 1000000, 10000000]
+# the synthetic incidents are spread over four years from this day on
+START = pd.Timestamp('2021-01-01')
+SPAN_SECONDS = 4 * 365 * 24 * 3600
+
+# values of the synthetic incidents, the city names include aliases, other towns and missing values like the real export
+CITIES = ['MORRISVILLE', 'MORR', 'MORRISILLE', 'MORRISVILLE N DURHAM', 'RALEIGH', 'DURHAM', None]
+CITY_WEIGHTS = [0.82, 0.04, 0.02, 0.02, 0.04, 0.03, 0.03]
+OFFENSES = ['LARCENY', 'ASSAULT', 'VANDALISM', 'BURGLARY', 'FRAUD', 'DRUG VIOLATION', 'DWI', 'TRESPASSING']
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+DISTRICTS = ['D1', 'D2', 'D3', 'D4', None]
+STREETS = ['{} {}'.format(number, name) for number in range(100, 1100, 100) for name in ('CHAPEL HILL RD', 'AIRPORT BLVD', 'MCCRIMMON PKWY', 'DAVIS DR')]
+SUBDIVISIONS = ['PARK WEST', 'BRECKENRIDGE', 'KITTS CREEK', 'SHILOH', None]
+# natural keys of the dimensions, like the dimension caches of create_dwh
+DIMENSION_KEYS = {'dim_location': ['geohash'], 'dim_crime': ['crime_type']}
+
+
+def random_timestamps(rng, rows):
+    return START + pd.to_timedelta(rng.integers(0, SPAN_SECONDS, rows), unit='s')
+
+
+def random_choice(rng, values, rows, weights=None):
+    return np.array(values, dtype=object)[rng.choice(len(values), rows, p=weights)]
+
+
+# coordinates around Morrisville rounded to about 10m, so that locations repeat like in the real data
+def random_coordinates(rng, rows):
+    latitude = np.round(35.82 + rng.normal(0, 0.02, rows), 4)
+    longitude = np.round(-78.83 + rng.normal(0, 0.02, rows), 4)
+    return latitude, longitude
+
+
+# the area dicts of the export, some are missing and some have latitude and longitude the other way round
+def random_areas(rng, rows):
+    latitude, longitude = random_coordinates(rng, rows)
+    swapped = rng.random(rows) < 0.1
+    latitude, longitude = np.where(swapped, longitude, latitude), np.where(swapped, latitude, longitude)
+    missing = rng.random(rows) < 0.05
+    return [None if is_missing else {'lat': lat, 'lon': lon} for lat, lon, is_missing in zip(latitude.tolist(), longitude.tolist(), missing.tolist())]
+
+
+# the columns of the raw morrisville table that are read by the cleanup
+def synthetic_raw(rows, seed):
+    rng = np.random.default_rng(seed)
+    occurred = random_timestamps(rng, rows)
+    return pd.DataFrame({
+        'occurred': occurred,
+        'weekday': random_choice(rng, WEEKDAYS, rows),
+        'month': occurred.month.astype(str),
+        'year': occurred.year,
+        'offense': random_choice(rng, OFFENSES, rows),
+        'street': random_choice(rng, STREETS, rows),
+        'city': random_choice(rng, CITIES, rows, CITY_WEIGHTS),
+        'subdivision': random_choice(rng, SUBDIVISIONS, rows),
+        'district': random_choice(rng, DISTRICTS, rows),
+        'area': random_areas(rng, rows)
+    })
+
+
+# records like the ones of the API export, the timestamps are ISO strings with UTC offset
+def synthetic_records(rows, seed):
+    df = synthetic_raw(rows, seed)
+    rng = np.random.default_rng(seed + 1)
+    records = pd.DataFrame({field: None for field in transforms.API_FIELDS}, index=df.index)
+    records['date_rept'] = (df['occurred'] + pd.to_timedelta(rng.integers(0, 86400, rows), unit='s')).dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+    records['date_occu'] = df['occurred'].dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+    records['dow1'] = df['weekday']
+    records['monthstamp'] = df['month']
+    records['yearstamp'] = df['year']
+    records['inci_id'] = np.arange(1, rows + 1)
+    for field, column in (('offense', 'offense'), ('street', 'street'), ('city', 'city'), ('subdivisn', 'subdivision'), ('district', 'district'), ('area', 'area')):
+        records[field] = df[column]
+    return records.to_dict('records')
+
+
+# the cleaned morrisville incidents that are merged into tbl_crimes
+def synthetic_clean(rows, seed):
+    rng = np.random.default_rng(seed)
+    occurred = pd.Series(random_timestamps(rng, rows))
+    latitude, longitude = random_coordinates(rng, rows)
+    swapped = rng.random(rows) < 0.1
+    return pd.DataFrame({
+        'occurred': occurred,
+        'rounded_timestamp': transforms.round_half_hour(occurred),
+        'weekday': random_choice(rng, WEEKDAYS, rows),
+        'offense': random_choice(rng, OFFENSES, rows),
+        'street': random_choice(rng, STREETS, rows),
+        'city': 'MORRISVILLE',
+        'subdivision': random_choice(rng, SUBDIVISIONS, rows),
+        'district': random_choice(rng, DISTRICTS, rows),
+        'latitude': np.where(swapped, longitude, latitude),
+        'longitude': np.where(swapped, latitude, longitude)
+    })
+
+
+# the cary incidents with separate date and time columns
+def synthetic_cary(rows, seed):
+    rng = np.random.default_rng(seed)
+    seconds = rng.integers(0, 86400, rows)
+    rounded_seconds = (seconds + 1800) // 3600 % 24 * 3600
+    latitude, longitude = random_coordinates(rng, rows)
+    return pd.DataFrame({
+        'date_from': random_timestamps(rng, rows).normalize().date,
+        'from_time': pd.to_datetime(seconds, unit='s').strftime('%H:%M:%S'),
+        'from_time_rounded': pd.to_datetime(rounded_seconds, unit='s').strftime('%H:%M:%S'),
+        'crimeday': random_choice(rng, WEEKDAYS, rows),
+        'crime_type': random_choice(rng, OFFENSES, rows),
+        'geocode': random_choice(rng, STREETS, rows),
+        'subdivisn_id': random_choice(rng, SUBDIVISIONS, rows),
+        'district': random_choice(rng, DISTRICTS, rows),
+        'lat': latitude,
+        'lon': longitude
+    })
+
+
+# hourly raw weather rows
+def synthetic_weather(rows, seed):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({'time': pd.date_range(START, periods=rows, freq='h')})
+    for column in transforms.RAW_WEATHER_COLUMNS[1:]:
+        df[column] = np.round(rng.normal(15, 8, rows), 1)
+    for column in ('relative_humidity_2m', 'weather_code', 'cloud_cover', 'is_day'):
+        df[column] = rng.integers(0, 100 if column != 'is_day' else 2, rows)
+    return df
+
+
+# merged incidents of tbl_crimes and dimension caches that know the keys of every second incident
+def synthetic_incidents(rows, seed):
+    df = transforms.map_morrisville(synthetic_clean(rows, seed))
+    df.insert(0, 'incident_id', np.arange(1, rows + 1))
+    preloaded = {}
+    frames = transforms.dimension_frames(df.iloc[::2])
+    for table, key_columns in DIMENSION_KEYS.items():
+        keys = frames[table][key_columns].dropna().drop_duplicates()
+        preloaded[table] = {key: number for number, key in enumerate(zip(*(keys[column] for column in key_columns)), start=1)}
+    return df, preloaded
+
+
+# snap the coordinates of the merged incidents to the geohash cells of dim_location
+def snap_locations(df):
+    return transforms.geohash(df['latitude'], df['longitude'])
+
+
+# the key resolution of create_dwh without the database, new keys get the next number instead of being inserted
+def resolve_dimensions(data):
+    df, preloaded = data
+    # the caches are copied so that every run starts with the same entries
+    caches = {table: dict(ids) for table, ids in preloaded.items()}
+    frames = transforms.dimension_frames(df)
+    fact_df = pd.DataFrame({'incident_id': df['incident_id']})
+    for table, key_columns in DIMENSION_KEYS.items():
+        ids = caches[table]
+        keys, valid, missing = transforms.match_keys(ids, frames[table], key_columns)
+        for key in {key for key, is_missing in zip(keys, missing) if is_missing}:
+            ids[key] = len(ids) + 1
+        fact_df[table] = [ids.get(key) if is_valid else None for key, is_valid in zip(keys, valid)]
+    return fact_df
+
+
+# lambda functions whose import is measured, every import runs in a new interpreter like in a new lambda container
+HANDLER_MODULES = ['etl_pipeline', 'etl_cleanup', 'load_dwh', 'create_dwh', 'weather_dwh', 'dwh_aggregates']
+# number of rows of the transformation calls of the cold start benchmark
+COLD_START_ROWS = 1000
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+start_time = time.perf_counter()
+__import__(sys.argv[1])
+seconds = time.perf_counter() - start_time
+print(json.dumps({'import_seconds': seconds, 'modules': len(sys.modules), 'pandas': 'pandas' in sys.modules}))
+'''
+
+FIRST_CALL_SCRIPT = '''
+import json, sys, time
+import benchmark
+generate, transform = benchmark.STAGES[sys.argv[1]]
+data = generate(int(sys.argv[2]), 42)
+seconds = []
+for call in range(2):
+    start_time = time.perf_counter()
+    transform(data)
+    seconds.append(time.perf_counter() - start_time)
+print(json.dumps({'first_call_seconds': seconds[0], 'warm_call_seconds': seconds[1]}))
+'''
+
+
+# name of the stage: function that generates the input and the transformation that is measured
+STAGES = {
+    'raw_frame': (synthetic_records, transforms.raw_frame),
+    'clean_raw': (synthetic_raw, transforms.clean_raw),
+    'map_morrisville': (synthetic_clean, transforms.map_morrisville),
+    'map_cary': (synthetic_cary, transforms.map_cary),
+    'weather_frame': (synthetic_weather, transforms.weather_frame),
+    'geohash': (lambda rows, seed: transforms.map_morrisville(synthetic_clean(rows, seed)), snap_locations),
+    'dimension_keys': (synthetic_incidents, resolve_dimensions)
+}
+
+
+# run a transformation once for the time and, unless memory is False, once more with tracemalloc for the peak memory
+# (tracemalloc slows down the allocations, so the run with it is not timed)
+def measure(transform, data, memory=True):
+    start_time = time.perf_counter()
+    output = transform(data)
+    seconds = time.perf_counter() - start_time
+    peak = None
+    if memory:
+        tracemalloc.start()
+        transform(data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return len(output), seconds, peak
+
+
+def run_benchmarks(sizes=SIZES, stages=None, seed=42, memory=True):
+    results = []
+    for rows in sizes:
+        for stage in stages or STAGES:
+            generate, transform = STAGES[stage]
+            data = generate(rows, seed)
+            rows_out, seconds, peak = measure(transform, data, memory)
+            result = {'stage': stage, 'rows_in': rows, 'rows_out': rows_out, 'seconds': round(seconds, 4), 'rows_per_sec': round(rows / seconds) if seconds else None, 'peak_mb': None if peak is None else round(peak / 2 ** 20, 1)}
+            print("{stage:<16} {rows_in:>10} rows  {seconds:>9.3f}s  {rows_per_sec:>12} rows/s  peak {peak_mb} MB".format(**result), flush=True)
+            results.append(result)
+            del data
+    return results
+
+
+# run a script in a new interpreter next to this file and return the JSON it prints, the best of the repeats is kept
+def run_fresh(script, args, repeat):
+    best = None
+    for _ in range(repeat):
+        completed = subprocess.run([sys.executable, '-c', script] + [str(arg) for arg in args], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        if completed.returncode != 0:
+            lines = completed.stderr.strip().splitlines()
+            return {'error': lines[-1] if lines else "exit code {}".format(completed.returncode)}
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        if best is None or list(result.values())[0] < list(best.values())[0]:
+            best = result
+    return best
+
+
+# import time of the lambda functions and first against warm call of the transformations, each in a new interpreter
+def run_cold_starts(modules=HANDLER_MODULES, stages=None, repeat=3):
+    results = []
+    for module in modules:
+        result = dict({'module': module}, **run_fresh(IMPORT_SCRIPT, [module], repeat))
+        print("import {module:<16} {result}".format(module=module, result={key: value for key, value in result.items() if key != 'module'}), flush=True)
+        results.append(result)
+    for stage in stages or STAGES:
+        result = dict({'stage': stage, 'rows': COLD_START_ROWS}, **run_fresh(FIRST_CALL_SCRIPT, [stage, COLD_START_ROWS], repeat))
+        print("call   {stage:<16} {result}".format(stage=stage, result={key: value for key, value in result.items() if key not in ('stage', 'rows')}), flush=True)
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the transformations on synthetic data")
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help="number of rows of the synthetic datasets")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), help="stages to run, all by default")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-memory', action='store_true', help="skip the second run that measures the peak memory")
+    parser.add_argument('--json', help="write the results to this file")
+    parser.add_argument('--cold-start', action='store_true', help="measure the import of the lambda functions and the first call of the transformations")
+    args = parser.parse_args()
+
+    if args.cold_start:
+        results = run_cold_starts(stages=args.stages)
+    else:
+        results = run_benchmarks(args.sizes, args.stages, args.seed, not args.no_memory)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+# column lists of the tables and sources, shared by the lambda functions and transforms.py. They are kept apart from the
+# transformations so that a function can use them without importing pandas
+
+
+# columns of the raw morrisville table and the matching fields of the API records, in the order they are copied
+RAW_TABLE_COLUMNS = ['reported', 'occurred', 'weekday', 'month', 'year', 'id', 'offense', 'street', 'city', 'state', 'zip', 'neighborhood', 'subdivision', 'tract', 'zone', 'district', 'asst_officers', 'area']
+API_FIELDS = ['date_rept', 'date_occu', 'dow1', 'monthstamp', 'yearstamp', 'inci_id', 'offense', 'street', 'city', 'state', 'zip', 'neighborhd', 'subdivisn', 'tract', 'zone', 'district', 'asst_offcr', 'area']
+
+# misspellings of the city name that are mapped to the canonical name
+CITY_ALIASES = {'MORR': 'MORRISVILLE', 'MORRISVILLE N DURHAM': 'MORRISVILLE', 'MORRISILLE': 'MORRISVILLE', 'MORRIVILLE': 'MORRISVILLE'}
+# entries of these cities are not part of the Morrisville dataset
+EXCLUDED_CITIES = ['RALEIGH', '<Redacted>', 'CLAYTON', 'DURHAM']
+# columns of the cleaned morrisville table in the order they are copied
+CLEAN_COLUMNS = ['occurred', 'weekday', 'month', 'year', 'offense', 'street', 'city', 'subdivision', 'district', 'latitude', 'longitude', 'rounded_timestamp']
+# incident id and content hash of the raw record, they are carried into the cleaned table so that the later stages can tell the changed records
+TRACKING_COLUMNS = ['id', 'record_hash']
+
+# columns of the merged table tbl_crimes in the order they are copied
+TBL_CRIMES_COLUMNS = ['datetime', 'rounded_time', 'weekday', 'crime_type', 'street', 'city', 'subdivision', 'district', 'latitude', 'longitude']
+
+# columns of dim_weather and the matching columns of the raw weather data
+WEATHER_COLUMNS = ['time', 'temp', 'humidity', 'dew_point', 'apparent_temp', 'precipitation', 'rain', 'snowfall', 'snow_depth', 'weather_code', 'cloud_cover', 'wind_speed', 'is_day']
+RAW_WEATHER_COLUMNS = ['time', 'temperature_2m', 'relative_humidity_2m', 'dew_point_2m', 'apparent_temperature', 'precipitation', 'rain', 'snowfall', 'snow_depth', 'weather_code', 'cloud_cover', 'wind_speed_10m', 'is_day']
@@ -0,0 +1,23 @@
+# settings of the lambda functions from the environment variables. They are read on the first use instead of at import time,
+# so that the modules can be imported without them (e.g. by the benchmarks), and all missing variables are reported at once
+
+import os
+
+
+# values that were read and checked already, the environment of a lambda container doesn't change
+_values = {}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# the values of the required variables in the given order
+def require(*names):
+    missing = [name for name in names if name not in _values and not os.environ.get(name)]
+    if missing:
+        raise ConfigError("Missing environment variables: {}".format(', '.join(missing)))
+    for name in names:
+        if name not in _values:
+            _values[name] = os.environ[name]
+    return [_values[name] for name in names]
@@ -1,25 +1,543 @@
 # create datawarehouse and load the crime data into the datawarehouse
 
-import json
+import datetime
+import io
 import os
 import psycopg2
-import pandas as pd
-import numpy as np
-from psycopg2.extras import Json
+from psycopg2.extras import execute_values
+import config
+import instrumentation
+from etl_db import HASHES_DDL, acquire, batches, begin_stage, clear_hashes, connect_metrics, copy_dataframe, diff_hashes, finish_stage, make_dsn, out_of_time, read_chunks, read_hashes, record_batch, release, reset_stage, run_batch, save_hashes, stored_hashes
 
+# columns of tbl_crimes that are staged into the DWH for the set-based load
+STAGE_COLUMNS = ['incident_id', 'datetime', 'rounded_time', 'weekday', 'crime_type', 'street', 'city', 'subdivision', 'district', 'latitude', 'longitude']
+# columns of tbl_crimes that are used by the in-memory dimension lookup
+FACT_SOURCE_COLUMNS = ['incident_id', 'rounded_time', 'weekday', 'crime_type', 'street', 'city', 'subdivision', 'district', 'latitude', 'longitude']
+# number of characters of the geohash that dim_location is keyed on, incidents in the same cell share a location
+LOCATION_PRECISION = int(os.environ.get('LOCATION_PRECISION', 8))
+# geohash of a pair of coordinates with the arithmetic of transforms.geohash, used by the sql engine and to key the
+# locations of older runs: the coordinates are snapped to the cells of the grid and the bits of both cell numbers are interleaved.
+# STRICT gives NULL for missing coordinates (greatest and least would ignore them), like transforms.geohash does
+GEOHASH_FUNCTION = (
+    "CREATE OR REPLACE FUNCTION geohash_encode(lat float, lon float, chars int) RETURNS text AS $$ "
+    "SELECT string_agg(substr('0123456789bcdefghjkmnpqrstuvwxyz', ((code >> (5 * (chars - 1 - k))) & 31)::int + 1, 1), '' ORDER BY k) "
+    "FROM (SELECT bit_or(CASE WHEN i % 2 = 0 THEN (x >> (lon_bits - 1 - i / 2)) & 1 ELSE (y >> (lat_bits - 1 - i / 2)) & 1 END << (5 * chars - 1 - i)) AS code "
+    "FROM (SELECT least(greatest(floor((lon + 180) / 360 * power(2.0::float8, lon_bits)), 0), power(2.0::float8, lon_bits) - 1)::bigint AS x, "
+    "least(greatest(floor((lat + 90) / 180 * power(2.0::float8, lat_bits)), 0), power(2.0::float8, lat_bits) - 1)::bigint AS y, lon_bits, lat_bits "
+    "FROM (SELECT (5 * chars + 1) / 2 AS lon_bits, 5 * chars / 2 AS lat_bits) sizes) cells, generate_series(0, 5 * chars - 1) AS i) interleaved, "
+    "generate_series(0, chars - 1) AS k "
+    "$$ LANGUAGE sql IMMUTABLE STRICT;"
+)
+# the address that keys the locations of incidents without coordinates (geohash NULL), a missing part counts as ''
+ADDRESS_COLUMNS = ['city', 'district', 'subdivision', 'street']
+ADDRESS_KEY = ', '.join("coalesce({}, '')".format(column) for column in ADDRESS_COLUMNS)
+# first day of the hourly calendar of dim_date, it ends with the year CALENDAR_YEARS_AHEAD years after the current one
+CALENDAR_START = os.environ.get('CALENDAR_START', '2021-01-01')
+CALENDAR_YEARS_AHEAD = int(os.environ.get('CALENDAR_YEARS_AHEAD', 1))
+# the hours from the first one up to the second one (exclusive) are 'day' in dim_date, the others 'night'
+DAY_HOURS = (6, 18)
+# columns of dim_date that are derived from the hour
+CALENDAR_COLUMNS = ['weekday', 'month', 'year', 'hour', 'day_of_week', 'iso_week', 'quarter', 'is_weekend', 'is_holiday', 'day_night']
+# all hours of a range with their derived attributes. Hours that were inserted by older runs (without the derived attributes)
+# are completed, the day of week is the ISO number (1 = Monday)
+CALENDAR_INSERT = (
+    "INSERT INTO dim_date (rounded_time, {0}) "
+    "SELECT t, to_char(t, 'FMDay'), EXTRACT(month FROM t)::int, EXTRACT(year FROM t)::int, EXTRACT(hour FROM t)::int, EXTRACT(isodow FROM t)::int, "
+    "EXTRACT(week FROM t)::int, EXTRACT(quarter FROM t)::int, EXTRACT(isodow FROM t) >= 6, t::date = ANY(%(holidays)s::date[]), "
+    "CASE WHEN EXTRACT(hour FROM t) >= %(day_start)s AND EXTRACT(hour FROM t) < %(night_start)s THEN 'day' ELSE 'night' END "
+    "FROM generate_series(date_trunc('hour', %(start)s::timestamp), %(end)s::timestamp, interval '1 hour') AS t "
+    "ON CONFLICT (rounded_time) DO UPDATE SET {1} WHERE dim_date.hour IS NULL;"
+).format(', '.join(CALENDAR_COLUMNS), ', '.join("{0} = EXCLUDED.{0}".format(column) for column in CALENDAR_COLUMNS))
+# name of the stage in the hash table of the DWH, the hashes are the ones of the incidents in tbl_crimes
+HASH_STAGE = 'facts'
 
-MORR_ENDPOINT = os.environ['MORR_ENDPOINT']
-MORR_DB = os.environ['MORR_DB']
-DWH_ENDPOINT = os.environ['DWH_ENDPOINT']
-DWH_NAME = os.environ['DWH_NAME']
-OV_USERNAME = os.environ['OV_USERNAME']
-OV_PASSWORD = os.environ['OV_PASSWORD']
+
+# connection strings of the morrisville database with tbl_crimes and of the DWH
+def morrisville_dsn():
+    return make_dsn(*config.require('MORR_ENDPOINT', 'MORR_DB', 'OV_USERNAME', 'OV_PASSWORD'))
+
+
+def dwh_dsn():
+    return make_dsn(*config.require('DWH_ENDPOINT', 'DWH_NAME', 'OV_USERNAME', 'OV_PASSWORD'))
+
+
+# in-memory map from the natural key of a dimension to its surrogate key, so that the fact build needs no lookups in the database.
+# With fill a missing value is part of the key as fill (the unique index is on the coalesced columns), otherwise rows with
+# a missing value get no entry. condition restricts the cache to the entries of a partial unique index
+class DimensionCache:
+    def __init__(self, table, id_column, key_columns, fill=None, condition=None):
+        self.table = table
+        self.id_column = id_column
+        self.key_columns = key_columns
+        self.fill = fill
+        self.condition = condition
+        self.key_sql = ', '.join(key_columns) if fill is None else ', '.join("coalesce({}, '{}')".format(column, fill) for column in key_columns)
+        self.ids = {}
+        self.hits = 0
+        self.misses = 0
+        self.failed = 0
+        # entries inserted by the current batch
+        self.added = []
+
+    # read all existing entries of the dimension once at the start of the run
+    def preload(self, cur):
+        cur.execute("SELECT {}, {} FROM {}{};".format(self.id_column, self.key_sql, self.table, " WHERE " + self.condition if self.condition else ""))
+        self.ids = {tuple(row[1:]): row[0] for row in cur.fetchall()}
+        return len(self.ids)
+
+    # get the surrogate keys for all rows of the frame (columns named like the dimension), new entries are inserted in one batch
+    def resolve(self, cur, frame):
+        from transforms import match_keys
+        keyed = frame if self.fill is None else frame.fillna({column: self.fill for column in self.key_columns})
+        keys, valid, missing = match_keys(self.ids, keyed, self.key_columns)
+        self.hits += sum(valid) - sum(missing)
+        
+        new_entries = frame.loc[missing][~keyed.loc[missing].duplicated(subset=self.key_columns).values]
+        if len(new_entries) > 0:
+            self.misses += len(new_entries)
+            rows = new_entries.astype(object).where(new_entries.notna(), None).values.tolist()
+            query = "INSERT INTO {0} ({1}) VALUES %s ON CONFLICT ({3}){4} DO NOTHING RETURNING {2}, {3};".format(
+                self.table, ', '.join(new_entries.columns), self.id_column, self.key_sql, " WHERE " + self.condition if self.condition else "")
+            returned = execute_values(cur, query, rows, fetch=True)
+            for row in returned:
+                self.ids[tuple(row[1:])] = row[0]
+                self.added.append(tuple(row[1:]))
+            self.failed += len(new_entries) - len(returned)
+
+        return [self.ids.get(key) if is_valid else None for key, is_valid in zip(keys, valid)]
+
+    # start a batch that is committed on its own
+    def begin(self):
+        self.added = []
+
+    # forget the entries of a batch that was rolled back, they are inserted again by the next attempt
+    def rollback(self):
+        for key in self.added:
+            self.ids.pop(key, None)
+        self.added = []
+
+    def stats(self):
+        return {'entries': len(self.ids), 'hits': self.hits, 'misses': self.misses, 'failed': self.failed}
+
+
+# the caches of dim_location (by geohash and, for incidents without coordinates, by address) and dim_crime with the existing
+# entries. dim_date is keyed by the hour itself and is only extended when an incident is outside of the calendar
+def dimension_caches(dwh_cur):
+    caches = {
+        'dim_location': DimensionCache('dim_location', 'location_id', ['geohash']),
+        'dim_location_address': DimensionCache('dim_location', 'location_id', ADDRESS_COLUMNS, fill='', condition='geohash IS NULL'),
+        'dim_crime': DimensionCache('dim_crime', 'crime_id', ['crime_type'])
+    }
+    for cache in caches.values():
+        cache.preload(dwh_cur)
+    return caches
+
+
+# temporary table that holds the newly built facts until they are written into the fact table. The table of an earlier
+# batch in the same transaction is emptied
+def create_new_facts(cur):
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS new_facts (incident_id int, crime_fk int, date_fk timestamp, location_fk int) ON COMMIT DROP;")
+    cur.execute("TRUNCATE new_facts;")
+
+
+# layout of the existing fact table: 'plain', 'partitioned' or None when it doesn't exist yet
+def fact_table_layout(cur):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('factless_fact');")
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return 'partitioned' if row[0] == 'p' else 'plain'
+
+
+# create the monthly partitions of the fact table for the months of the new facts
+def create_fact_partitions(cur):
+    cur.execute("SELECT DISTINCT date_trunc('month', date_fk) FROM new_facts WHERE date_fk IS NOT NULL;")
+    months = [row[0] for row in cur.fetchall()]
+    for month in months:
+        next_month = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+        cur.execute("CREATE TABLE IF NOT EXISTS factless_fact_{:%Y_%m} PARTITION OF factless_fact FOR VALUES FROM (%s) TO (%s);".format(month), (month, next_month))
+    return len(months)
+
+
+# write the new facts into the fact table: 'incremental' appends the incidents that aren't loaded yet, 'full' replaces
+# the content of the table in the same transaction. The old facts are deleted instead of truncated, so readers keep
+# seeing them until the commit instead of waiting for the lock of a TRUNCATE
+def write_facts(cur, fact_mode):
+    if fact_mode == 'full':
+        cur.execute("DELETE FROM factless_fact;")
+    if fact_table_layout(cur) == 'partitioned':
+        # a fact without date has no partition
+        create_fact_partitions(cur)
+        cur.execute("INSERT INTO factless_fact (incident_id, crime_fk, date_fk, location_fk) SELECT incident_id, crime_fk, date_fk, location_fk FROM new_facts WHERE date_fk IS NOT NULL ORDER BY incident_id ON CONFLICT DO NOTHING;")
+    else:
+        cur.execute("INSERT INTO factless_fact (incident_id, crime_fk, date_fk, location_fk) SELECT incident_id, crime_fk, date_fk, location_fk FROM new_facts ORDER BY incident_id ON CONFLICT DO NOTHING;")
+    return cur.rowcount
+
+
+# create the fact table, 'partitioned' splits it into range partitions per month of date_fk so that queries on a time range
+# only read the partitions of their months. None keeps the existing layout, a table with another layout is dropped and
+# reloaded by the next run (together with the aggregate views that depend on it)
+def create_fact_table(dwh_cur, fact_layout=None):
+    current_layout = fact_table_layout(dwh_cur)
+    if fact_layout is None:
+        fact_layout = current_layout or 'plain'
+    if fact_layout not in ('plain', 'partitioned'):
+        raise ValueError(f"Unknown fact layout: {fact_layout}")
+    if current_layout == fact_layout:
+        return fact_layout
+    if current_layout is not None:
+        print(f"Changing the layout of factless_fact from {current_layout} to {fact_layout}, the facts are loaded again")
+        dwh_cur.execute("DROP TABLE factless_fact CASCADE;")
+        # without the hashes of the dropped facts the next run loads all incidents
+        reset_stage(dwh_cur, HASH_STAGE)
+    
+    if fact_layout == 'partitioned':
+        # the primary key and the unique key of a partitioned table have to contain the partition column
+        dwh_cur.execute("CREATE TABLE factless_fact (fact_id SERIAL, crime_fk INT REFERENCES dim_crime(crime_id), date_fk timestamp NOT NULL REFERENCES dim_date(rounded_time), location_fk INT REFERENCES dim_location(location_id), incident_id int, PRIMARY KEY (fact_id, date_fk)) PARTITION BY RANGE (date_fk);")
+        dwh_cur.execute("CREATE UNIQUE INDEX factless_fact_incident_id_key ON factless_fact (incident_id, date_fk);")
+    else:
+        dwh_cur.execute("CREATE TABLE factless_fact (fact_id SERIAL PRIMARY KEY, crime_fk INT REFERENCES dim_crime(crime_id), date_fk timestamp REFERENCES dim_date(rounded_time), location_fk INT REFERENCES dim_location(location_id), incident_id int);")
+    return fact_layout
+
+
+# the day of the nth (or with n = -1 the last) weekday (0 = Monday) of a month
+def nth_weekday(year, month, weekday, n):
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+# the US federal holidays of the years (the day itself, not the observed day off)
+def federal_holidays(years):
+    days = []
+    for year in years:
+        days += [
+            datetime.date(year, 1, 1), nth_weekday(year, 1, 0, 3), nth_weekday(year, 2, 0, 3), nth_weekday(year, 5, 0, -1),
+            datetime.date(year, 7, 4), nth_weekday(year, 9, 0, 1), nth_weekday(year, 10, 0, 2), datetime.date(year, 11, 11),
+            nth_weekday(year, 11, 3, 4), datetime.date(year, 12, 25)
+        ]
+        # Juneteenth is a federal holiday since 2021
+        if year >= 2021:
+            days.append(datetime.date(year, 6, 19))
+    return sorted(days)
+
+
+# the configured range of the calendar
+def calendar_range():
+    return datetime.datetime.fromisoformat(CALENDAR_START), datetime.datetime(datetime.date.today().year + CALENDAR_YEARS_AHEAD, 12, 31, 23)
+
+
+# make sure that dim_date has every hour from start to end with all attributes, the missing hours are generated with one
+# statement. Returns the number of generated (or completed) hours, nothing is written if the range is complete already
+def create_calendar(cur, start, end):
+    params = {'start': start, 'end': end}
+    cur.execute("SELECT (SELECT count(*) FROM dim_date WHERE rounded_time BETWEEN date_trunc('hour', %(start)s::timestamp) AND %(end)s::timestamp AND hour IS NOT NULL) "
+                "= (SELECT count(*) FROM generate_series(date_trunc('hour', %(start)s::timestamp), %(end)s::timestamp, interval '1 hour'));", params)
+    if cur.fetchone()[0]:
+        return 0
+    params.update({'holidays': federal_holidays(range(start.year, end.year + 1)), 'day_start': DAY_HOURS[0], 'night_start': DAY_HOURS[1]})
+    cur.execute(CALENDAR_INSERT, params)
+    print(f"Generated {cur.rowcount} hours of dim_date from {start} to {end}")
+    return cur.rowcount
+
+
+# key the locations by the geohash cell of their coordinates. Locations of older runs (or of another precision) get the
+# geohash of the current precision and locations in the same cell are merged into the one with the lowest id, their facts
+# are moved to it. Returns the number of merged locations
+def snap_locations(cur, precision=LOCATION_PRECISION):
+    cur.execute("SELECT EXISTS (SELECT 1 FROM dim_location WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND (geohash IS NULL OR length(geohash) <> %s));", (precision,))
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("DROP INDEX IF EXISTS dim_location_geohash_key;")
+    cur.execute("DROP TABLE IF EXISTS location_cells;")
+    cur.execute("CREATE TEMP TABLE location_cells ON COMMIT DROP AS SELECT location_id, cell, min(location_id) OVER (PARTITION BY cell) AS canonical_id FROM (SELECT location_id, geohash_encode(latitude, longitude, %s) AS cell FROM dim_location WHERE latitude IS NOT NULL AND longitude IS NOT NULL) cells;", (precision,))
+    cur.execute("UPDATE factless_fact SET location_fk = c.canonical_id FROM location_cells c WHERE factless_fact.location_fk = c.location_id AND c.location_id <> c.canonical_id;")
+    cur.execute("DELETE FROM dim_location USING location_cells c WHERE dim_location.location_id = c.location_id AND c.location_id <> c.canonical_id;")
+    merged = cur.rowcount
+    cur.execute("UPDATE dim_location SET geohash = c.cell FROM location_cells c WHERE dim_location.location_id = c.location_id AND dim_location.geohash IS DISTINCT FROM c.cell;")
+    print(f"Keyed dim_location by geohash with {precision} characters, {merged} locations were merged")
+    return merged
+
+
+# the locations of incidents without coordinates have no geohash and are keyed by their address instead. Older runs gave
+# every such incident its own location, the python engine none and the sql engine the cell '0...0'. The first run with the
+# address key merges the locations of the same address and forgets the hashes of the incidents without coordinates, so
+# that the next fact load links them to the location of their address. Returns the number of merged locations
+def key_addresses(cur):
+    cur.execute("SELECT to_regclass('dim_location_address_key') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        return 0
+    cur.execute("UPDATE dim_location SET geohash = NULL WHERE (latitude IS NULL OR longitude IS NULL) AND geohash IS NOT NULL;")
+    cur.execute("DROP TABLE IF EXISTS address_locations;")
+    cur.execute("CREATE TEMP TABLE address_locations ON COMMIT DROP AS SELECT location_id, min(location_id) OVER (PARTITION BY {}) AS canonical_id FROM dim_location WHERE geohash IS NULL;".format(ADDRESS_KEY))
+    cur.execute(HASHES_DDL)
+    cur.execute("DELETE FROM etl_hashes h USING factless_fact f WHERE h.stage = %s AND h.key = f.incident_id::text AND (f.location_fk IS NULL OR f.location_fk IN (SELECT location_id FROM address_locations));", (HASH_STAGE,))
+    cur.execute("UPDATE factless_fact SET location_fk = a.canonical_id FROM address_locations a WHERE factless_fact.location_fk = a.location_id AND a.location_id <> a.canonical_id;")
+    cur.execute("DELETE FROM dim_location USING address_locations a WHERE dim_location.location_id = a.location_id AND a.location_id <> a.canonical_id;")
+    print(f"Keyed the locations without coordinates by their address, {cur.rowcount} locations were merged")
+    return cur.rowcount
+
+
+# create the fact and dimension tables
+def create_star_schema(dwh_cur, fact_layout=None):
+    dwh_cur.execute("CREATE TABLE IF NOT EXISTS dim_location (location_id SERIAL PRIMARY KEY, city text, street text, subdivision text, district text, latitude float, longitude float, geohash text);")
+    dwh_cur.execute("CREATE TABLE IF NOT EXISTS dim_crime (crime_id SERIAL PRIMARY KEY, crime_type text);")
+    dwh_cur.execute("CREATE TABLE IF NOT EXISTS dim_date (rounded_time timestamp PRIMARY KEY, weekday text, month text, year int, hour int, day_of_week int, iso_week int, quarter int, is_weekend boolean, is_holiday boolean, day_night text);")
+    fact_layout = create_fact_table(dwh_cur, fact_layout)
+    
+    # dim_date is a calendar of all hours of the configured range, generated up front so that the fact load never inserts into it
+    # (tables of older runs get the derived attributes)
+    dwh_cur.execute("ALTER TABLE dim_date ADD COLUMN IF NOT EXISTS hour int, ADD COLUMN IF NOT EXISTS day_of_week int, ADD COLUMN IF NOT EXISTS iso_week int, ADD COLUMN IF NOT EXISTS quarter int, "
+                    "ADD COLUMN IF NOT EXISTS is_weekend boolean, ADD COLUMN IF NOT EXISTS is_holiday boolean, ADD COLUMN IF NOT EXISTS day_night text;")
+    calendar_start, calendar_end = calendar_range()
+    dwh_cur.execute("SELECT min(rounded_time), max(rounded_time) FROM dim_date WHERE hour IS NULL;")
+    first, last = dwh_cur.fetchone()
+    if first is not None:
+        calendar_start, calendar_end = min(first, calendar_start), max(last, calendar_end)
+    create_calendar(dwh_cur, calendar_start, calendar_end)
+    
+    # the locations are keyed by their geohash instead of the exact coordinates (tables of older runs don't have the column yet)
+    dwh_cur.execute("ALTER TABLE dim_location ADD COLUMN IF NOT EXISTS geohash text;")
+    dwh_cur.execute("DROP INDEX IF EXISTS dim_location_lat_lon_key;")
+    dwh_cur.execute(GEOHASH_FUNCTION)
+    key_addresses(dwh_cur)
+    snap_locations(dwh_cur)
+    
+    # unique indexes on the natural keys of the dimensions (dim_date is keyed on rounded_time already). The pattern ops of the
+    # geohash index also serve the prefix filters (geohash LIKE 'dnrg%') of the dashboards
+    dwh_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dim_location_geohash_key ON dim_location (geohash text_pattern_ops);")
+    dwh_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dim_location_address_key ON dim_location ({}) WHERE geohash IS NULL;".format(ADDRESS_KEY))
+    dwh_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dim_crime_crime_type_key ON dim_crime (crime_type);")
+    
+    # crime_id has its own sequence, tables of older runs took it from the id of the first incident of the crime type
+    dwh_cur.execute("SELECT column_default IS NULL FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'dim_crime' AND column_name = 'crime_id';")
+    if dwh_cur.fetchone()[0]:
+        dwh_cur.execute("CREATE SEQUENCE IF NOT EXISTS dim_crime_crime_id_seq OWNED BY dim_crime.crime_id;")
+        dwh_cur.execute("SELECT setval('dim_crime_crime_id_seq', coalesce(max(crime_id), 0) + 1, false) FROM dim_crime;")
+        dwh_cur.execute("ALTER TABLE dim_crime ALTER COLUMN crime_id SET DEFAULT nextval('dim_crime_crime_id_seq');")
+    
+    # the incident of tbl_crimes is kept as degenerate key in the fact table to know which incidents are loaded
+    # (fact tables of older runs don't have the column yet). The partitioned table has its unique key on (incident_id, date_fk)
+    dwh_cur.execute("ALTER TABLE factless_fact ADD COLUMN IF NOT EXISTS incident_id int;")
+    if fact_layout == 'plain':
+        dwh_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS factless_fact_incident_id_key ON factless_fact (incident_id);")
+    
+    # indexes on the foreign keys for the joins of the dashboards and the weather link, on a partitioned table
+    # they are created on every partition
+    dwh_cur.execute("CREATE INDEX IF NOT EXISTS factless_fact_crime_fk_idx ON factless_fact (crime_fk);")
+    dwh_cur.execute("CREATE INDEX IF NOT EXISTS factless_fact_date_fk_idx ON factless_fact (date_fk);")
+    dwh_cur.execute("CREATE INDEX IF NOT EXISTS factless_fact_location_fk_idx ON factless_fact (location_fk);")
+    return fact_layout
+
+
+# facts from before the degenerate key was added can't be matched, so the table is rebuilt once. An empty fact table with
+# stored hashes (e.g. emptied by hand) is loaded again from scratch, the hashes would skip all incidents
+def check_fact_mode(dwh_cur, fact_mode):
+    if fact_mode not in ('incremental', 'full'):
+        raise ValueError(f"Unknown fact mode: {fact_mode}")
+    dwh_cur.execute("SELECT EXISTS (SELECT 1 FROM factless_fact WHERE incident_id IS NULL);")
+    if dwh_cur.fetchone()[0]:
+        return 'full'
+    dwh_cur.execute(HASHES_DDL)
+    dwh_cur.execute("SELECT NOT EXISTS (SELECT 1 FROM factless_fact) AND EXISTS (SELECT 1 FROM etl_hashes WHERE stage = %s);", (HASH_STAGE,))
+    if dwh_cur.fetchone()[0]:
+        reset_stage(dwh_cur, HASH_STAGE)
+        return 'full'
+    return fact_mode
+
+
+# compare the hashes of the incidents in tbl_crimes with the ones of the last run and delete the facts of the removed
+# incidents, the facts of the changed ones are replaced batch by batch. A full run that isn't resumed forgets the hashes,
+# so all incidents are built again while the old facts stay readable until their batch replaces them. Returns the source
+# hashes and the keys
+def fact_changes(mor_conn, dwh_cur, fact_mode, resumed=False):
+    instrumentation.enter('extract')
+    source = read_hashes(mor_conn, "SELECT incident_id, record_hash FROM tbl_crimes;")
+    instrumentation.enter('load')
+    if fact_mode == 'full' and not resumed:
+        clear_hashes(dwh_cur, HASH_STAGE)
+    changed, removed = diff_hashes(source, stored_hashes(dwh_cur, HASH_STAGE))
+    if removed:
+        dwh_cur.execute("DELETE FROM factless_fact WHERE incident_id = ANY(%s);", ([int(key) for key in removed],))
+        instrumentation.count(rows_out=dwh_cur.rowcount)
+        save_hashes(dwh_cur, HASH_STAGE, source, [], removed)
+    return source, changed, removed
+
+
+# the end of a full run: the facts that no batch has built (their incident is no longer in tbl_crimes or they are from
+# before the degenerate key) are deleted
+def delete_stale_facts(dwh_cur):
+    dwh_cur.execute("DELETE FROM factless_fact f WHERE f.incident_id IS NULL OR NOT EXISTS (SELECT 1 FROM etl_hashes h WHERE h.stage = %s AND h.key = f.incident_id::text);", (HASH_STAGE,))
+    return dwh_cur.rowcount
+
+
+# build the facts of a batch of incidents in its own transaction: the old facts of the incidents are replaced and their
+# hashes stored, so a retried or resumed batch writes the same facts again. tbl_crimes is read on a pooled connection
+# that is taken for every attempt. The dimension caches of the python engine are kept over the batches of a run
+def fact_batch(engine, source, keys, caches=None):
+    for cache in (caches or {}).values():
+        cache.begin()
+    def write(dwh_cur):
+        # the entries of a failed attempt were rolled back with it
+        for cache in (caches or {}).values():
+            cache.rollback()
+        dwh_cur.execute("DELETE FROM factless_fact WHERE incident_id = ANY(%s);", ([int(key) for key in keys],))
+        mor_conn = acquire(morrisville_dsn())
+        mor_conn.autocommit = True
+        try:
+            if engine == 'sql':
+                with mor_conn.cursor() as mor_cur:
+                    built = build_star_schema_sql(mor_cur, dwh_cur, 'incremental', keys)
+            else:
+                built = build_star_schema_python(mor_conn, dwh_cur, 'incremental', keys, caches)
+        finally:
+            release(mor_conn)
+        instrumentation.enter('post_sql')
+        save_hashes(dwh_cur, HASH_STAGE, source, keys, [])
+        record_batch(dwh_cur, HASH_STAGE, built['facts'])
+        return built
+    return write
+
+
+# the condition on the incidents of tbl_crimes that are read, None reads all of them
+def incident_filter(keys):
+    if keys is None:
+        return "", None
+    return " WHERE incident_id = ANY(%s)", ([int(key) for key in keys],)
+
+
+# read tbl_crimes (or only the incidents with the given ids) chunk by chunk and build the facts from it
+def build_star_schema_python(mor_conn, dwh_cur, fact_mode, keys=None, caches=None):
+    where, params = incident_filter(keys)
+    chunks = read_chunks(mor_conn, "SELECT {} FROM tbl_crimes{} ORDER BY incident_id;".format(', '.join(FACT_SOURCE_COLUMNS), where), params)
+    return load_facts(dwh_cur, chunks, fact_mode, caches)
+
+
+# resolve the dimension keys of the incident dataframes (columns of tbl_crimes) with the in-memory caches and write the facts.
+# Without caches (of dimension_caches) the existing dimension entries are loaded into memory first
+def load_facts(dwh_cur, chunks, fact_mode, caches=None):
+    # pandas is only needed by the python engine
+    import pandas as pd
+    from transforms import dimension_frames
+    
+    if caches is None:
+        caches = dimension_caches(dwh_cur)
+    location_cache, address_cache, crime_cache = caches['dim_location'], caches['dim_location_address'], caches['dim_crime']
+    calendar_start, calendar_end = calendar_range()
+    calendar_hours = 0
+    
+    create_new_facts(dwh_cur)
+    
+    run = instrumentation.current_run()
+    if run is not None:
+        chunks = run.iterate(chunks, 'extract')
+    for df_mor in chunks:
+        instrumentation.enter('transform')
+        rows_in = len(df_mor)
+        #the incidents of the chunk that are already in the fact table are skipped
+        if fact_mode == 'incremental':
+            dwh_cur.execute("SELECT incident_id FROM factless_fact WHERE incident_id = ANY(%s);", (df_mor['incident_id'].astype(int).tolist(),))
+            loaded_ids = {row[0] for row in dwh_cur.fetchall()}
+            df_mor = df_mor[~df_mor['incident_id'].isin(loaded_ids)]
+        if len(df_mor) == 0:
+            instrumentation.count(rows_in=rows_in)
+            continue
+
+        #the values of the dimensions, named like the columns of the dimension tables
+        dimensions = dimension_frames(df_mor, LOCATION_PRECISION)
+        rounded_time = pd.to_datetime(df_mor['rounded_time'])
+        if rounded_time.notna().any() and (rounded_time.min() < calendar_start or rounded_time.max() > calendar_end):
+            calendar_start = min(calendar_start, rounded_time.min().to_pydatetime())
+            calendar_end = max(calendar_end, rounded_time.max().to_pydatetime())
+            calendar_hours += create_calendar(dwh_cur, calendar_start, calendar_end)
+
+        #resolve the IDs locally, entries that don't exist yet are inserted in one batch per dimension.
+        #incidents without coordinates get the location of their address
+        locations = dimensions['dim_location']
+        location_fk = location_cache.resolve(dwh_cur, locations)
+        no_cell = locations['geohash'].isna().tolist()
+        if any(no_cell):
+            address_fk = iter(address_cache.resolve(dwh_cur, locations[no_cell]))
+            location_fk = [next(address_fk) if missing else fk for fk, missing in zip(location_fk, no_cell)]
+        fact_df = pd.DataFrame({
+            'incident_id': df_mor['incident_id'].tolist(),
+            'crime_fk': crime_cache.resolve(dwh_cur, dimensions['dim_crime']),
+            'date_fk': rounded_time.astype(object).where(rounded_time.notna(), None).tolist(),
+            'location_fk': location_fk
+        }, dtype=object)
+
+        instrumentation.count(rows_in=rows_in, rows_out=len(fact_df))
+
+        #collect the IDs of the chunk for the fact table
+        instrumentation.enter('load')
+        copy_dataframe(dwh_cur, 'new_facts', fact_df)
+    
+    #load the IDs into the facttable and create a new ID as PK
+    instrumentation.enter('load')
+    facts_written = write_facts(dwh_cur, fact_mode)
+    instrumentation.count(rows_out=facts_written)
+
+    return {'facts': facts_written, 'dimension_cache': {table: cache.stats() for table, cache in caches.items()}, 'calendar_hours': calendar_hours}
+
+
+# stage tbl_crimes (or only the incidents with the given ids) into the DWH with one COPY and build the dimensions and
+# the fact table with a few set-based statements
+def build_star_schema_sql(mor_cur, dwh_cur, fact_mode, keys=None):
+    columns = ', '.join(STAGE_COLUMNS)
+    where, params = incident_filter(keys)
+    instrumentation.enter('extract')
+    dwh_cur.execute("CREATE TEMP TABLE IF NOT EXISTS stage_crimes (incident_id int, datetime timestamp, rounded_time timestamp, weekday text, crime_type text, street text, city text, subdivision text, district text, latitude float, longitude float, geohash text) ON COMMIT DROP;")
+    dwh_cur.execute("TRUNCATE stage_crimes;")
+    buffer = io.StringIO()
+    mor_cur.copy_expert("COPY (SELECT {} FROM tbl_crimes{}) TO STDOUT".format(columns, mor_cur.mogrify(where, params).decode('utf-8') if params else where), buffer)
+    instrumentation.count(bytes_fetched=len(buffer.getvalue().encode('utf-8')))
+    buffer.seek(0)
+    dwh_cur.copy_expert("COPY stage_crimes ({}) FROM STDIN".format(columns), buffer)
+    instrumentation.count(rows_out=dwh_cur.rowcount)
+    
+    #skip the incidents that are already in the fact table
+    if fact_mode == 'incremental':
+        dwh_cur.execute("DELETE FROM stage_crimes WHERE incident_id IN (SELECT incident_id FROM factless_fact WHERE incident_id IS NOT NULL);")
+    dwh_cur.execute("UPDATE stage_crimes SET geohash = geohash_encode(latitude, longitude, %s);", (LOCATION_PRECISION,))
+    dwh_cur.execute("ANALYZE stage_crimes;")
+    
+    instrumentation.enter('transform')
+    # new dimension entries, the first incident of each natural key provides the attributes
+    dwh_cur.execute("INSERT INTO dim_location (city, street, subdivision, district, latitude, longitude, geohash) SELECT DISTINCT ON (geohash) city, street, subdivision, district, latitude, longitude, geohash FROM stage_crimes WHERE geohash IS NOT NULL ORDER BY geohash, incident_id ON CONFLICT (geohash) DO NOTHING;")
+    new_locations = dwh_cur.rowcount
+    dwh_cur.execute("INSERT INTO dim_location (city, street, subdivision, district) SELECT DISTINCT ON ({0}) city, street, subdivision, district FROM stage_crimes WHERE geohash IS NULL ORDER BY {0}, incident_id ON CONFLICT ({0}) WHERE geohash IS NULL DO NOTHING;".format(ADDRESS_KEY))
+    new_locations += dwh_cur.rowcount
+    # dim_date is only extended if incidents are outside of the calendar
+    dwh_cur.execute("SELECT min(rounded_time), max(rounded_time) FROM stage_crimes;")
+    first, last = dwh_cur.fetchone()
+    calendar_start, calendar_end = calendar_range()
+    new_dates = 0
+    if first is not None and (first < calendar_start or last > calendar_end):
+        new_dates = create_calendar(dwh_cur, min(first, calendar_start), max(last, calendar_end))
+    dwh_cur.execute("INSERT INTO dim_crime (crime_type) SELECT DISTINCT crime_type FROM stage_crimes WHERE crime_type IS NOT NULL ORDER BY crime_type ON CONFLICT (crime_type) DO NOTHING;")
+    new_crimes = dwh_cur.rowcount
+    
+    #build the facts with the IDs of the dimension tables
+    create_new_facts(dwh_cur)
+    dwh_cur.execute("INSERT INTO new_facts (incident_id, crime_fk, date_fk, location_fk) SELECT stage_crimes.incident_id, dim_crime.crime_id, dim_date.rounded_time, coalesce(dim_location.location_id, address.location_id) FROM stage_crimes LEFT JOIN dim_crime ON dim_crime.crime_type = stage_crimes.crime_type LEFT JOIN dim_date ON dim_date.rounded_time = stage_crimes.rounded_time LEFT JOIN dim_location ON dim_location.geohash = stage_crimes.geohash "
+                    "LEFT JOIN dim_location address ON stage_crimes.geohash IS NULL AND address.geohash IS NULL AND {} ORDER BY stage_crimes.incident_id;".format(' AND '.join("coalesce(address.{0}, '') = coalesce(stage_crimes.{0}, '')".format(column) for column in ADDRESS_COLUMNS)))
+    
+    instrumentation.enter('load')
+    facts_written = write_facts(dwh_cur, fact_mode)
+    instrumentation.count(rows_out=facts_written)
+    
+    return {'facts': facts_written, 'new_dimension_entries': {'dim_location': new_locations, 'dim_date': new_dates, 'dim_crime': new_crimes}}
 
 
 def lambda_handler(event, context):
+    run = instrumentation.start_run('create_dwh')
+    
     # Connect to the morrisville database
+    run.enter('connect')
     try:
-        mor_conn = psycopg2.connect("host={} dbname={} user={} password={}".format(MORR_ENDPOINT, MORR_DB, OV_USERNAME, OV_PASSWORD))
+        mor_conn = acquire(morrisville_dsn())
 
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
@@ -33,7 +551,7 @@ def lambda_handler(event, context):
     
     # Connect to the dwh
     try:
-        dwh_conn = psycopg2.connect("host={} dbname={} user={} password={}".format(DWH_ENDPOINT, DWH_NAME, OV_USERNAME, OV_PASSWORD))
+        dwh_conn = acquire(dwh_dsn())
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
         print(e)
@@ -45,166 +563,84 @@ def lambda_handler(event, context):
         print(e)
         
 
-    # Auto commit
+    # Auto commit for the source, the DWH is written in transactions
     mor_conn.set_session(autocommit=True)
-    dwh_conn.set_session(autocommit=True)
+    dwh_conn.set_session(autocommit=False)
     
-    # create the fact and dimension tables
-    
-    dwh_cur.execute("CREATE TABLE IF NOT EXISTS dim_location (location_id SERIAL PRIMARY KEY, city text, street text, subdivision text, district text, latitude float, longitude float);")
-    dwh_cur.execute("CREATE TABLE IF NOT EXISTS dim_crime (crime_id INT PRIMARY KEY, crime_type text);")
-    dwh_cur.execute("CREATE TABLE IF NOT EXISTS dim_date (rounded_time timestamp PRIMARY KEY, weekday text, month text, year int);")
-    dwh_cur.execute("CREATE TABLE IF NOT EXISTS factless_fact (fact_id SERIAL PRIMARY KEY, crime_fk INT REFERENCES dim_crime(crime_id), date_fk timestamp REFERENCES dim_date(rounded_time), location_fk INT REFERENCES dim_location(location_id));")
-    
-    dwh_conn.commit()
-    
-    
-    #Get data from morrisville database
+    # create the fact and dimension tables, 'fact_layout' ('plain' or 'partitioned') changes the layout of the fact table
+    run.enter('post_sql')
     try:
-        mor_cur.execute("SELECT * FROM tbl_crimes;")
-    except psycopg2.Error as e:
-        print(f"Error executing the query. Error: {e}")
-        
-    #load the data into a dataframe
-    columns = [desc[0] for desc in mor_cur.description]
-    data_raw = mor_cur.fetchall()
-    df_mor = pd.DataFrame(data_raw, columns=columns)
-    
-    #check if the data already exists in the different dimension tables, if yes get the ID
-    check_query_loc = "SELECT location_id FROM dim_location WHERE latitude = %s AND longitude = %s;"
-    check_query_dat = "SELECT rounded_time FROM dim_date WHERE rounded_time = %s;"
-    check_query_inc = "SELECT crime_id FROM dim_crime WHERE crime_type = %s;"
-
-    fact_records = []
-
-    #load the data into the dwh
-    for index, row in df_mor.iterrows():
-        #this is the value used for the check of the existing entries defined above
-        check_values_loc = (row['latitude'], row['longitude'])
-        check_values_dat = (row['rounded_time'],)
-        check_values_inc = (row['crime_type'],)
-        
-
-        # execute the check and get the existing IDs (if possible)
-        dwh_cur.execute(check_query_loc, check_values_loc)
-        existing_location_id = dwh_cur.fetchone()
-        
-        dwh_cur.execute(check_query_dat, check_values_dat)
-        existing_date_id = dwh_cur.fetchone()
-        
-        dwh_cur.execute(check_query_inc, check_values_inc)
-        existing_crime_id = dwh_cur.fetchone()
-
-        # if the data doesn't in the location dimension, make a new entry
-        if existing_location_id is None:
-            query_loc = "INSERT INTO dim_location (location_id, city, street, subdivision, district, latitude, longitude) VALUES (DEFAULT, %s, %s, %s, %s, %s, %s);"
-            values_loc = (
-                row['city'],
-                row['street'],
-                row['subdivision'],
-                row['district'],
-                row['latitude'],
-                row['longitude']
-                )
-            try:
-                dwh_cur.execute(query_loc, values_loc)
-                dwh_conn.commit()
-            except psycopg2.Error as e:
-                print(f"An error occurred: {str(e)}")
-        
-        #now make again a select for the ID
-        dwh_cur.execute(check_query_loc, check_values_loc)
-        #save the id for the later use
-        location_id = dwh_cur.fetchone()
-        
-        # if the data doesn't in the date dimension, make a new entry
-        if existing_date_id is None:
-            year_value = row['rounded_time'].year
-            month_value = row['rounded_time'].month
-            query_date = "INSERT INTO dim_date (rounded_time, weekday, month, year) VALUES (%s, %s, %s, %s);"
-            values_date = (
-                row['rounded_time'],
-                row['weekday'],
-                month_value,
-                year_value
-                )
-            try:
-                dwh_cur.execute(query_date, values_date)
-                dwh_conn.commit()
-            except psycopg2.Error as e:
-                print(f"An error occurred: {str(e)}")
-                
-        #now make again a select for the ID
-        dwh_cur.execute(check_query_dat, check_values_dat)
-        #save the id for the later use
-        date_id = dwh_cur.fetchone()
-        
-        # if the data doesn't in the crime dimension, make a new entry
-        if existing_crime_id is None:
-            query_incident = "INSERT INTO dim_crime (crime_id, crime_type) VALUES (%s, %s);"
-            values_incident = (
-                row['incident_id'],
-                row['crime_type']
-                )
-            try:
-                dwh_cur.execute(query_incident, values_incident)
-                dwh_conn.commit()
-            except psycopg2.Error as e:
-                print(f"An error occurred: {str(e)}")
-                
-        #now make again a select for the ID    
-        dwh_cur.execute(check_query_inc, check_values_inc)
-        #save the id for the later use
-        crime_id = dwh_cur.fetchone()
-        
-        # Append fact record (all three IDs from the different dimension tables) to the list
-        fact_records.append({
-            'crime_fk': crime_id,
-            'date_fk': date_id,
-            'location_fk': location_id
-        })
+        fact_layout = create_star_schema(dwh_cur, (event or {}).get('fact_layout'))
+        dwh_conn.commit()
+    except (psycopg2.Error, ValueError) as e:
+        dwh_conn.rollback()
+        print(f"Error creating the star schema: {e}")
+        fact_layout = None
     
-    fact_df = pd.DataFrame(fact_records)
     
+    # 'python' resolves the keys with the in-memory dimension cache, 'sql' builds the star schema inside PostgreSQL
+    engine = (event or {}).get('engine', 'python')
+    # 'incremental' only loads the incidents whose hash is new or changed, 'full' rebuilds the fact table.
+    # A run that didn't finish (e.g. a timeout of the lambda function) is resumed by the next invocation
+    fact_mode = (event or {}).get('fact_mode', 'incremental')
+    max_batches = (event or {}).get('max_batches')
+    
+    result = {'engine': engine, 'fact_layout': fact_layout, 'facts': 0, 'batches': 0, 'finished': False}
     try:
-        #delete existing records from the fact table
-        dwh_cur.execute("DELETE FROM factless_fact;")
+        if engine not in ('sql', 'python'):
+            raise ValueError(f"Unknown engine: {engine}")
+        fact_mode = check_fact_mode(dwh_cur, fact_mode)
+        fact_mode, resumed = begin_stage(dwh_cur, HASH_STAGE, fact_mode)
+        result['fact_mode'] = fact_mode
+        source, changed, removed = fact_changes(mor_conn, dwh_cur, fact_mode, resumed)
         dwh_conn.commit()
+        result.update({'changed': len(changed), 'removed': len(removed)})
         
-        #load the IDs into the facttable and create a new ID as PK
-        for _, fact_row in fact_df.iterrows():
-            query_fact = "INSERT INTO factless_fact (fact_id, crime_fk, date_fk, location_fk) VALUES (DEFAULT, %s, %s, %s);"
-            values_fact = (
-                fact_row['crime_fk'], 
-                fact_row['date_fk'],
-                fact_row['location_fk']
-                )
-            dwh_cur.execute(query_fact, values_fact)
-    
-        dwh_conn.commit()
-    except Exception as e:
-        print(f"Error writing fact table to PostgreSQL: {e}")
+        # every batch is committed with the hashes of its incidents, so a failed or interrupted load continues after
+        # the last committed batch. The python engine reads the dimensions into its caches once per run
+        caches = dimension_caches(dwh_cur) if engine == 'python' else None
+        new_entries = {}
+        finished = True
+        for number, keys in enumerate(batches(changed)):
+            if out_of_time(context) or (max_batches is not None and number >= int(max_batches)):
+                finished = False
+                break
+            built, dwh_conn = run_batch(dwh_conn, fact_batch(engine, source, keys, caches))
+            result['facts'] += built['facts']
+            result['batches'] += 1
+            # the sql engine counts the new dimension entries, the python engine the calendar hours
+            for table, count in built.get('new_dimension_entries', {}).items():
+                new_entries[table] = new_entries.get(table, 0) + count
+            if 'calendar_hours' in built:
+                result['calendar_hours'] = result.get('calendar_hours', 0) + built['calendar_hours']
+        if engine == 'sql':
+            result['new_dimension_entries'] = new_entries
+        else:
+            result['dimension_cache'] = {table: cache.stats() for table, cache in caches.items()}
+        
+        run.enter('post_sql')
+        if finished:
+            def finish(cur):
+                stale = delete_stale_facts(cur) if fact_mode == 'full' else 0
+                finish_stage(cur, HASH_STAGE)
+                return stale
+            stale, dwh_conn = run_batch(dwh_conn, finish)
+            result['removed'] += stale
+        result['finished'] = finished
+    except (psycopg2.Error, ValueError) as e:
+        # the batches that were committed are kept, the next invocation resumes after them
+        dwh_conn.rollback()
+        print(f"Error writing the star schema to PostgreSQL: {e}")
+    print(f"Star schema load: {result}")
 
 
     #close connection to the  database
     mor_cur.close()
-    mor_conn.close()
+    release(mor_conn)
     
     dwh_cur.close()
-    dwh_conn.close()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    release(dwh_conn)
 
-    
\ No newline at end of file
+    result['connections'] = connect_metrics()
+    result['metrics'] = instrumentation.finish_run(run)
+    return result
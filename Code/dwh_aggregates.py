@@ -0,0 +1,112 @@
+# pre-aggregated crime counts for the Tableau dashboards, they are built as materialized views on top of the star schema
+# and refreshed after the weather dimension is loaded, so that the dashboards don't aggregate the fact table on every load
+
+import time
+import psycopg2
+import config
+import instrumentation
+from etl_db import acquire, connect_metrics, make_dsn, release
+
+
+# width of the temperature buckets in degrees
+TEMP_BUCKET_SIZE = 5
+
+# query and key columns of each view. The keys are never NULL (missing values are grouped as 'UNKNOWN' or -1),
+# the unique index on them is needed to refresh the view concurrently
+AGGREGATES = {
+    'agg_daily_crimes': (
+        ['day', 'city', 'district', 'crime_type'],
+        "SELECT date_trunc('day', f.date_fk)::date AS day, COALESCE(l.city, 'UNKNOWN') AS city, COALESCE(l.district, 'UNKNOWN') AS district, "
+        "COALESCE(c.crime_type, 'UNKNOWN') AS crime_type, count(*) AS crimes "
+        "FROM factless_fact f LEFT JOIN dim_location l ON l.location_id = f.location_fk LEFT JOIN dim_crime c ON c.crime_id = f.crime_fk "
+        "WHERE f.date_fk IS NOT NULL GROUP BY 1, 2, 3, 4"
+    ),
+    'agg_hourly_heatmap': (
+        ['weekday', 'hour', 'crime_type'],
+        "SELECT COALESCE(d.weekday, 'UNKNOWN') AS weekday, d.hour AS hour, COALESCE(c.crime_type, 'UNKNOWN') AS crime_type, count(*) AS crimes "
+        "FROM factless_fact f JOIN dim_date d ON d.rounded_time = f.date_fk LEFT JOIN dim_crime c ON c.crime_id = f.crime_fk "
+        "GROUP BY 1, 2, 3"
+    ),
+    'agg_weather_crimes': (
+        ['weather_code', 'temp_bucket', 'crime_type'],
+        "SELECT COALESCE(w.weather_code, -1) AS weather_code, COALESCE((floor(w.temp / {0}) * {0})::int, -1) AS temp_bucket, "
+        "COALESCE(c.crime_type, 'UNKNOWN') AS crime_type, count(*) AS crimes "
+        "FROM factless_fact f JOIN dim_weather w ON w.weather_id = f.weather_fk LEFT JOIN dim_crime c ON c.crime_id = f.crime_fk "
+        "GROUP BY 1, 2, 3".format(TEMP_BUCKET_SIZE)
+    )
+}
+
+
+# connection string of the DWH
+def dwh_dsn():
+    return make_dsn(*config.require('DWH_ENDPOINT', 'DWH_NAME', 'OV_USERNAME', 'OV_PASSWORD'))
+
+
+# create the views that don't exist yet (they are filled on creation) together with their unique index, returns the created views
+def create_aggregates(cur):
+    cur.execute("SELECT matviewname FROM pg_matviews WHERE schemaname = current_schema();")
+    existing = {row[0] for row in cur.fetchall()}
+    created = []
+    for name, (key_columns, query) in AGGREGATES.items():
+        if name in existing:
+            continue
+        cur.execute("CREATE MATERIALIZED VIEW {} AS {};".format(name, query))
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS {0}_key ON {0} ({1});".format(name, ', '.join(key_columns)))
+        created.append(name)
+    return created
+
+
+# refresh one view, 'concurrent' keeps the view readable while it is rebuilt and only writes the changed rows,
+# 'full' locks the view but is faster when most of the rows change
+def refresh_aggregate(cur, name, refresh_mode):
+    if refresh_mode == 'concurrent':
+        cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY {};".format(name))
+    elif refresh_mode == 'full':
+        cur.execute("REFRESH MATERIALIZED VIEW {};".format(name))
+    else:
+        raise ValueError(f"Unknown refresh mode: {refresh_mode}")
+
+
+def lambda_handler(event, context):
+    run = instrumentation.start_run('dwh_aggregates')
+    
+    # Connect to the dwh
+    run.enter('connect')
+    try:
+        dwh_conn = acquire(dwh_dsn())
+    except psycopg2.Error as e:
+        print("Error: Could not make connection to the Postgres database")
+        print(e)
+
+    try:
+        dwh_cur = dwh_conn.cursor()
+    except psycopg2.Error as e:
+        print("Error: Could not get curser to the Database")
+        print(e)
+
+    # every view is refreshed in its own transaction, so that the locks are held as short as possible
+    dwh_conn.set_session(autocommit=True)
+
+    run.enter('post_sql')
+    refresh_mode = (event or {}).get('refresh_mode', 'concurrent')
+    result = {'refresh_mode': refresh_mode, 'created': [], 'refreshed': {}}
+    try:
+        result['created'] = create_aggregates(dwh_cur)
+        for name in AGGREGATES:
+            # a view that was just created is up to date already
+            if name in result['created']:
+                continue
+            start_time = time.perf_counter()
+            refresh_aggregate(dwh_cur, name, refresh_mode)
+            result['refreshed'][name] = round(time.perf_counter() - start_time, 3)
+    except (psycopg2.Error, ValueError) as e:
+        print(f"Error refreshing the aggregates: {e}")
+    print(f"Aggregates: {result}")
+
+    #close connection to the  database
+    dwh_cur.close()
+    release(dwh_conn)
+
+    result['connections'] = connect_metrics()
+    result['metrics'] = instrumentation.finish_run(run)
+    return result
@@ -1,26 +1,64 @@
 # this is the second function for the Morrisville dataset. Here the raw data is extracted from the RDS and cleaned up before loading into a new database.
 
-import json
-import os
 import psycopg2
-import pandas as pd
-import numpy as np
-from psycopg2.extras import Json
+import config
+from columns import TRACKING_COLUMNS
+from etl_db import acquire, batches, begin_rebuild, begin_stage, clear_hashes, connect_metrics, copy_dataframe, diff_hashes, finish_stage, make_dsn, out_of_time, read_frame, read_hashes, record_batch, release, run_batch, save_hashes, stored_hashes, swap_rebuild
+import instrumentation
+import landing_zone
+from transforms import clean_raw
 
 
-ENDPOINT1 = os.environ['ENDPOINT1']
-DB_NAME1 = os.environ['DB_NAME1']
-ENDPOINT2 = os.environ['ENDPOINT2']
-DB_NAME2 = os.environ['DB_NAME2']
-USERNAME = os.environ['USERNAME']
-PASSWORD = os.environ['PASSWORD']
+# columns of the raw table that are used for the cleanup, the other ones are not relevant for the final data structure
+RAW_COLUMNS = ['occurred', 'weekday', 'month', 'year', 'offense', 'street', 'city', 'subdivision', 'district', 'area']
+# the rounded timestamp is used later on to join it with the weather dataset which only has hourly data
+# id and record_hash are the incident id and content hash of the raw record
+CLEAN_TABLE_DDL = "CREATE TABLE IF NOT EXISTS morrisville (incident_id SERIAL PRIMARY KEY, occurred timestamp, weekday text, month text, year int, offense text, street text, city text, subdivision text, district text, latitude float, longitude float, rounded_timestamp timestamp, id int, record_hash text);"
+# name of the stage in the hash table of the clean database
+HASH_STAGE = 'cleanup'
 
 
+# connection strings of the raw data lake and of the database with the cleaned data
+def raw_dsn():
+    return make_dsn(*config.require('ENDPOINT1', 'DB_NAME1', 'USERNAME', 'PASSWORD'))
+
+
+def clean_dsn():
+    return make_dsn(*config.require('ENDPOINT2', 'DB_NAME2', 'USERNAME', 'PASSWORD'))
+
+
+# clean the raw parquet files of the landing zone into the clean dataset. With months (list of [year, month]) only these
+# partitions are read and replaced, otherwise the whole clean dataset is rebuilt
+def clean_landing_zone(root, months=None):
+    instrumentation.enter('extract')
+    df_raw = landing_zone.read_partitions('raw', columns=RAW_COLUMNS, months=months, root=root)
+    instrumentation.count(rows_out=len(df_raw))
+    instrumentation.enter('transform')
+    df_clean = clean_raw(df_raw)
+    instrumentation.count(rows_in=len(df_raw), rows_out=len(df_clean))
+    instrumentation.enter('load')
+    landing_zone.clear_dataset('clean', months=months, root=root)
+    partitions = landing_zone.write_partitions(df_clean, 'clean', root=root)
+    instrumentation.count(rows_in=len(df_clean), rows_out=len(df_clean))
+    print(f"Cleaned {len(df_raw)} raw rows into {len(df_clean)} rows in {len(partitions)} partitions of the landing zone")
+    return {'rows': len(df_clean), 'partitions': len(partitions)}
+
 
 def lambda_handler(event, context):
+    event = event or {}
+    run = instrumentation.start_run('etl_cleanup')
+    
+    # with a landing zone the cleanup works on the parquet files and doesn't need the databases
+    landing_root = event.get('landing_zone', landing_zone.LANDING_ZONE_PATH)
+    if landing_root:
+        result = clean_landing_zone(landing_root, event.get('months'))
+        result['metrics'] = instrumentation.finish_run(run)
+        return result
+    
     # Connect to the postgres database with raw data
+    run.enter('connect')
     try:
-        conn1 = psycopg2.connect("host={} dbname={} user={} password={}".format(ENDPOINT1, DB_NAME1, USERNAME, PASSWORD))
+        conn1 = acquire(raw_dsn())
 
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
@@ -35,7 +73,7 @@ def lambda_handler(event, context):
     
     # Connect to the new postgres database
     try:
-        conn2 = psycopg2.connect("host={} dbname={} user={} password={}".format(ENDPOINT2, DB_NAME2, USERNAME, PASSWORD))
+        conn2 = acquire(clean_dsn())
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
         print(e)
@@ -47,86 +85,115 @@ def lambda_handler(event, context):
         print(e)
         
 
-    # Auto commit
+    # Auto commit for the read, every batch of the new table is committed on its own
     conn1.set_session(autocommit=True)
-    conn2.set_session(autocommit=True)
+    conn2.set_session(autocommit=False)
     
     
-    #Get data from database with raw data
-    try:
-        cur1.execute("SELECT * FROM morrisville;")
-    except psycopg2.Error as e:
-        print(f"Error executing the query. Error: {e}")
-        
-    #load the data into a dataframe for the cleanup
-    columns = [desc[0] for desc in cur1.description]
-    data_raw = cur1.fetchall()
-    df1 = pd.DataFrame(data_raw, columns=columns)
-    
-    #close connection to the first database
-    cur1.close()
-    conn1.close()
-    
-    #Transform/cleanup
-    #remove columns that are not relevant for the final data structure
-    columns_to_drop = ['neighborhood', 'state', 'reported', 'id', 'tract', 'zone', 'zip', 'asst_officers']
-    df1.drop(columns=columns_to_drop, inplace=True)
+    # 'incremental' only cleans the raw records whose hash is new or changed since the last run, 'full' rebuilds the table.
+    # A run that didn't finish (e.g. a timeout of the lambda function) is resumed by the next invocation
+    clean_mode = event.get('mode', 'incremental')
+    max_batches = event.get('max_batches')
     
     #Create new table and load data into new database   
+    result = {'mode': clean_mode, 'rows': 0, 'changed': 0, 'removed': 0, 'batches': 0, 'finished': False}
     try:
-
+        run.enter('load')
+        cur2.execute(CLEAN_TABLE_DDL)
+        cur2.execute("ALTER TABLE morrisville ADD COLUMN IF NOT EXISTS id int, ADD COLUMN IF NOT EXISTS record_hash text;")
+        # a table from before the hashes can't be updated by id and is rebuilt
+        cur2.execute("SELECT EXISTS (SELECT 1 FROM morrisville WHERE id IS NULL);")
+        if cur2.fetchone()[0]:
+            clean_mode = 'full'
+        if clean_mode not in ('incremental', 'full'):
+            raise ValueError(f"Unknown cleanup mode: {clean_mode}")
+        clean_mode, resumed = begin_stage(cur2, HASH_STAGE, clean_mode)
+        result['mode'] = clean_mode
+        cur2.execute("CREATE INDEX IF NOT EXISTS morrisville_id_idx ON morrisville (id);")
         
-        # Delete "morrisville" table
-        cur2.execute("DROP TABLE IF EXISTS morrisville;")
+        # a full run cleans into a new table that replaces "morrisville" when the run finished, until then the old table is read
+        table = 'morrisville'
+        if clean_mode == 'full':
+            table, started = begin_rebuild(cur2, 'morrisville', resumed)
+            if started:
+                clear_hashes(cur2, HASH_STAGE)
+        conn2.commit()
         
-        #Create new table
-        cur2.execute("CREATE TABLE IF NOT EXISTS morrisville (incident_id SERIAL PRIMARY KEY, occurred timestamp, weekday text, month text, year int, offense text, street text, city text, subdivision text, district text, latitude float, longitude float);")
+        # the hashes of all raw records, only the id and hash columns are read
+        run.enter('extract')
+        source = read_hashes(conn1, "SELECT id, record_hash FROM morrisville WHERE id IS NOT NULL;")
         
+        # the hashes also cover the raw records that the cleanup removes, so they aren't cleaned again on every run.
+        # The batches of a resumed run that were committed already have the new hashes and are skipped
+        run.enter('load')
+        changed, removed = diff_hashes(source, stored_hashes(cur2, HASH_STAGE))
         conn2.commit()
+        result.update({'changed': len(changed), 'removed': len(removed)})
+        
+        # the records that are no longer in the raw table
+        def delete_removed(cur):
+            cur.execute("DELETE FROM {} WHERE id = ANY(%s);".format(table), ([int(key) for key in removed],))
+            save_hashes(cur, HASH_STAGE, source, [], removed)
+            record_batch(cur, HASH_STAGE, 0)
+        if removed:
+            _, conn2 = run_batch(conn2, delete_removed)
+        
+        # clean the new and changed records batch by batch, each batch replaces its records and stores their hashes
+        def clean_batch(keys):
+            def write(cur):
+                #Get data from database with raw data, only the columns that are relevant for the final data structure
+                run.enter('extract')
+                df1 = read_frame(raw_dsn(), "SELECT {} FROM morrisville WHERE id = ANY(%s);".format(', '.join(RAW_COLUMNS + TRACKING_COLUMNS)), ([int(key) for key in keys],))
+                
+                #Transform/cleanup
+                #round the timestamps, normalise the city names and remove entries that are not relevant before the load
+                run.enter('transform')
+                df_clean = clean_raw(df1) if df1 is not None else None
+                run.count(rows_in=len(df1) if df1 is not None else 0, rows_out=len(df_clean) if df_clean is not None else 0)
+                
+                # Bulk load the cleaned data into the PostgreSQL table
+                run.enter('load')
+                cur.execute("DELETE FROM {} WHERE id = ANY(%s);".format(table), ([int(key) for key in keys],))
+                copied = copy_dataframe(cur, table, df_clean) if df_clean is not None else 0
+                run.count(rows_in=copied, rows_out=copied)
+                save_hashes(cur, HASH_STAGE, source, keys, [])
+                record_batch(cur, HASH_STAGE, copied)
+                return copied
+            return write
+        
+        finished = True
+        for number, keys in enumerate(batches(changed)):
+            # leave the rest to the next invocation
+            if out_of_time(context) or (max_batches is not None and number >= int(max_batches)):
+                finished = False
+                break
+            copied, conn2 = run_batch(conn2, clean_batch(keys))
+            result['rows'] += copied
+            result['batches'] += 1
+        
+        # Commit the changes to the database
+        run.enter('post_sql')
+        if finished:
+            def finish(cur):
+                if clean_mode == 'full':
+                    swap_rebuild(cur, 'morrisville')
+                finish_stage(cur, HASH_STAGE)
+            _, conn2 = run_batch(conn2, finish)
+        result['finished'] = finished
+        print(f"Cleaned {result['rows']} rows in {result['batches']} batches ({clean_mode}), {len(changed)} new or changed and {len(removed)} removed raw records" + ("" if finished else ", the next invocation resumes"))
     
-        # Insert the data into the PostgreSQL table
-        for index, row in df1.iterrows():
-            occurred_value = row['occurred']
-            if pd.isna(occurred_value):
-                occurred_value = None  # Set to None for proper handling by psycopg2
-
-            query = "INSERT INTO morrisville (incident_id, occurred, weekday, month, year, offense, street, city, subdivision, district, latitude, longitude) VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
-            values = (
-                occurred_value,
-                row['weekday'],
-                row['month'],
-                row['year'],
-                row['offense'],
-                row['street'],
-                row['city'],
-                row['subdivision'],
-                row['district'],
-                row['area']['lat'],
-                row['area']['lon']
-            )
-            try:
-                cur2.execute(query, values)
-            except psycopg2.Error as e:
-                print(f"An error occurred: {str(e)}")
-    
-    except psycopg2.Error as e:
+    except (psycopg2.Error, ValueError) as e:
+        # the batches that were committed are kept, the next invocation resumes after them
+        conn2.rollback()
         print(f"An error occurred: {str(e)}")
 
-    # add a new column with timestamp rounded to full hours so that we can later on join it with the waeather dataset which only has hourly data
-    cur2.execute("ALTER TABLE morrisville ADD COLUMN rounded_timestamp TIMESTAMP;")
-    cur2.execute("UPDATE morrisville SET rounded_timestamp = CASE WHEN EXTRACT(minute FROM occurred) < 30 THEN date_trunc('hour', occurred) ELSE date_trunc('hour', occurred) + interval '1 hour' END;")
-    
-    # Update values in the "city" column
-    cur2.execute("UPDATE morrisville SET city = 'MORRISVILLE' WHERE city IN('MORR', 'MORRISVILLE N DURHAM', 'MORRISILLE', 'MORRIVILLE');")
-    cur2.execute("DELETE FROM morrisville WHERE city IS NULL or city IN ('RALEIGH', '<Redacted>', 'CLAYTON', 'DURHAM');")
-    
-    # Remove entries with missing timestamp
-    cur2.execute("DELETE FROM morrisville WHERE rounded_timestamp IS NULL;")
-    
-    # Commit the changes to the database
-    conn2.commit()
+    #close connection to the first database
+    cur1.close()
+    release(conn1)
 
     # Close the cursor and the database connection
     cur2.close()
-    conn2.close()
+    release(conn2)
 
+    result.update({'connections': connect_metrics(), 'metrics': instrumentation.finish_run(run)})
+    return result
@@ -0,0 +1,339 @@
+# shared database helpers of the lambda functions, this file is deployed together with each function
+
+import io
+import os
+import threading
+import time
+import uuid
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+import instrumentation
+
+
+# number of rows that are fetched from the server and processed at once
+CHUNK_SIZE = int(os.environ.get('CHUNK_SIZE', 10000))
+# seconds to wait for a new connection
+CONNECT_TIMEOUT = int(os.environ.get('CONNECT_TIMEOUT', 10))
+
+# attempts of a batch and the wait before the first retry in seconds, the wait doubles with every attempt
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 4))
+RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF', 0.5))
+# a lambda function stops after the batch that leaves less than this time (in milliseconds) and the next invocation resumes
+STOP_MARGIN_MS = int(os.environ.get('STOP_MARGIN_MS', 60000))
+# errors after which a batch is tried again: lost connections (e.g. an RDS failover), serialization failures and deadlocks
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.extensions.TransactionRollbackError)
+
+# progress of the last run of every stage, the table is kept in the database the stage writes to
+LOAD_STATE_DDL = "CREATE TABLE IF NOT EXISTS etl_load_state (stage text PRIMARY KEY, mode text, batches int, rows int, started_at timestamp, updated_at timestamp, finished_at timestamp);"
+# suffix of the copy of a table that a full rebuild is loaded into
+REBUILD_SUFFIX = '_rebuild'
+# hashes of the source rows that a stage has written, the table is kept in the database the stage writes to
+HASHES_DDL = "CREATE TABLE IF NOT EXISTS etl_hashes (stage text, key text, record_hash text, PRIMARY KEY (stage, key));"
+
+# idle connections per connection string, they are kept at module level so that warm lambda containers reuse them
+_idle_connections = {}
+_pool_lock = threading.Lock()
+# counters of the connections over the lifetime of the container
+_connect_metrics = {'connects': 0, 'reuses': 0, 'failed_health_checks': 0, 'connect_seconds': 0.0, 'last_connect_seconds': None}
+
+
+# cursor that counts its statements for the metrics of the run
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        instrumentation.count(statements=1)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        instrumentation.count(statements=1)
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        instrumentation.count(statements=1)
+        return super().copy_expert(sql, file, size)
+
+
+# connection that remembers the connection string of its pool (conn.dsn hides the password) and counts the commits
+class PooledConnection(psycopg2.extensions.connection):
+    pool_key = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = CountingCursor
+
+    def commit(self):
+        instrumentation.count(commits=1)
+        return super().commit()
+
+
+def make_dsn(host, dbname, user, password):
+    return "host={} dbname={} user={} password={}".format(host, dbname, user, password)
+
+
+# check that an idle connection is still usable and leave it without open transaction
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    try:
+        conn.rollback()
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+# get a connection for the connection string, an idle connection of an earlier invocation is reused if it is still healthy
+def acquire(dsn):
+    while True:
+        with _pool_lock:
+            idle = _idle_connections.get(dsn)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            break
+        if _is_healthy(conn):
+            conn.autocommit = False
+            with _pool_lock:
+                _connect_metrics['reuses'] += 1
+            return conn
+        with _pool_lock:
+            _connect_metrics['failed_health_checks'] += 1
+        _close_quietly(conn)
+
+    start_time = time.perf_counter()
+    conn = psycopg2.connect(dsn, connect_timeout=CONNECT_TIMEOUT, connection_factory=PooledConnection)
+    elapsed = time.perf_counter() - start_time
+    conn.pool_key = dsn
+    with _pool_lock:
+        _connect_metrics['connects'] += 1
+        _connect_metrics['connect_seconds'] += elapsed
+        _connect_metrics['last_connect_seconds'] = round(elapsed, 4)
+    return conn
+
+
+# give the connection back to the pool instead of closing it, an open transaction is rolled back
+def release(conn):
+    if conn is None or conn.closed:
+        return
+    try:
+        conn.rollback()
+    except psycopg2.Error:
+        _close_quietly(conn)
+        return
+    with _pool_lock:
+        _idle_connections.setdefault(conn.pool_key, []).append(conn)
+
+
+# close all pooled connections, e.g. at the end of a local run
+def close_all():
+    with _pool_lock:
+        connections = [conn for idle in _idle_connections.values() for conn in idle]
+        _idle_connections.clear()
+    for conn in connections:
+        _close_quietly(conn)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+# a usable connection for the next attempt: the same one if it is still healthy (its transaction is rolled back),
+# otherwise a new connection with the same connection string
+def reconnect(conn):
+    if _is_healthy(conn):
+        return conn
+    _close_quietly(conn)
+    return acquire(conn.pool_key)
+
+
+# run write(cur) in a transaction and commit it. A transient error rolls the batch back and runs it again after an
+# exponential backoff, so the writes of a batch have to be idempotent. Returns the result of write and the connection,
+# which is replaced when it was lost
+def run_batch(conn, write, attempts=RETRY_ATTEMPTS, backoff=RETRY_BACKOFF):
+    for attempt in range(attempts):
+        try:
+            with conn.cursor() as cur:
+                result = write(cur)
+            conn.commit()
+            return result, conn
+        except TRANSIENT_ERRORS as e:
+            if attempt == attempts - 1:
+                raise
+            delay = backoff * 2 ** attempt
+            print(f"Transient error, the batch is retried in {delay:.1f}s: {e}")
+            instrumentation.count(retries=1)
+            time.sleep(delay)
+            conn = reconnect(conn)
+
+
+# whether the lambda function should stop after the current batch and leave the rest to the next invocation
+def out_of_time(context, margin=STOP_MARGIN_MS):
+    return context is not None and hasattr(context, 'get_remaining_time_in_millis') and context.get_remaining_time_in_millis() < margin
+
+
+# start a run of the stage or resume the one that didn't finish. Returns the mode of the run and whether it is resumed,
+# the batches that a resumed run committed already are not written again
+def begin_stage(cur, stage, mode):
+    cur.execute(LOAD_STATE_DDL)
+    cur.execute("SELECT mode, batches FROM etl_load_state WHERE stage = %s AND finished_at IS NULL;", (stage,))
+    row = cur.fetchone()
+    if row is not None:
+        print(f"Resuming {stage} ({row[0]}) after {row[1]} committed batches")
+        return row[0], True
+    cur.execute("INSERT INTO etl_load_state (stage, mode, batches, rows, started_at, updated_at) VALUES (%s, %s, 0, 0, now(), now()) "
+                "ON CONFLICT (stage) DO UPDATE SET mode = EXCLUDED.mode, batches = 0, rows = 0, started_at = now(), updated_at = now(), finished_at = NULL;", (stage, mode))
+    return mode, False
+
+
+# count a batch of the stage, in the transaction of the batch
+def record_batch(cur, stage, rows):
+    cur.execute("UPDATE etl_load_state SET batches = batches + 1, rows = rows + %s, updated_at = now() WHERE stage = %s;", (rows, stage))
+
+
+# the number of rows that the run of the stage has committed so far
+def stage_rows(cur, stage):
+    cur.execute("SELECT rows FROM etl_load_state WHERE stage = %s;", (stage,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def finish_stage(cur, stage):
+    cur.execute("UPDATE etl_load_state SET finished_at = now(), updated_at = now() WHERE stage = %s;", (stage,))
+
+
+# the full rebuild of a table is loaded batch by batch into a copy of the table (columns, defaults, constraints and
+# indexes) and swapped in by the last transaction of the run, so that readers see the old table until the rebuild is
+# complete. A resumed rebuild continues with its copy. Returns the name of the copy and whether it was started anew
+def begin_rebuild(cur, table, resumed=False):
+    rebuild = table + REBUILD_SUFFIX
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (rebuild,))
+    if resumed and cur.fetchone()[0]:
+        return rebuild, False
+    cur.execute("DROP TABLE IF EXISTS {};".format(rebuild))
+    cur.execute("CREATE TABLE {} (LIKE {} INCLUDING ALL);".format(rebuild, table))
+    return rebuild, True
+
+
+# replace the table with its rebuild. The sequences of the table (serial columns) move to the rebuild and its indexes get
+# the names of the indexes of the old table
+def swap_rebuild(cur, table):
+    rebuild = table + REBUILD_SUFFIX
+    cur.execute("SELECT s.oid::regclass::text, a.attname FROM pg_depend d JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S' "
+                "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid WHERE d.refobjid = %s::regclass AND d.deptype = 'a';", (table,))
+    for sequence, column in cur.fetchall():
+        cur.execute("ALTER SEQUENCE {} OWNED BY {}.{};".format(sequence, rebuild, column))
+    cur.execute("SELECT old.indexrelid::regclass::text, new.indexrelid::regclass::text FROM pg_index old JOIN pg_index new ON new.indrelid = %s::regclass "
+                "AND new.indkey::text = old.indkey::text AND new.indisunique = old.indisunique WHERE old.indrelid = %s::regclass;", (rebuild, table))
+    indexes = cur.fetchall()
+    cur.execute("DROP TABLE {};".format(table))
+    cur.execute("ALTER TABLE {} RENAME TO {};".format(rebuild, table))
+    for old_name, new_name in indexes:
+        cur.execute("ALTER INDEX {} RENAME TO {};".format(new_name, old_name))
+
+
+# forget the progress and the hashes of the stage after its table was replaced, so that the next run starts anew
+def reset_stage(cur, stage):
+    cur.execute(LOAD_STATE_DDL)
+    cur.execute("DELETE FROM etl_load_state WHERE stage = %s;", (stage,))
+    clear_hashes(cur, stage)
+
+
+# split a list of keys into batches
+def batches(keys, size=CHUNK_SIZE):
+    return [keys[start:start + size] for start in range(0, len(keys), size)]
+
+
+def connect_metrics():
+    with _pool_lock:
+        metrics = dict(_connect_metrics)
+    metrics['connect_seconds'] = round(metrics['connect_seconds'], 4)
+    return metrics
+
+
+# read the result of a query in dataframes of chunk_size rows with a server-side (named) cursor,
+# so that only one chunk is held in memory instead of the whole table
+def read_chunks(conn, query, params=None, chunk_size=CHUNK_SIZE):
+    import pandas as pd
+    # withhold keeps the cursor usable on connections in autocommit mode
+    cur = conn.cursor(name="read_chunks_{}".format(uuid.uuid4().hex), withhold=True)
+    cur.itersize = chunk_size
+    try:
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            # the description of a named cursor is only available after the first fetch
+            columns = [desc[0] for desc in cur.description]
+            df = pd.DataFrame(rows, columns=columns)
+            # the size of the fetched data is counted as the memory of the chunk
+            instrumentation.count(rows_out=len(df), bytes_fetched=int(df.memory_usage(index=False, deep=True).sum()))
+            yield df
+    finally:
+        cur.close()
+
+
+# read the whole result of a query into one dataframe on a pooled connection, None if there are no rows. Every call gets
+# a healthy connection, so a retried batch reads again after a lost connection
+def read_frame(dsn, query, params=None):
+    import pandas as pd
+    conn = acquire(dsn)
+    conn.autocommit = True
+    try:
+        frames = list(read_chunks(conn, query, params))
+    finally:
+        release(conn)
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+
+# load a dataframe with a single COPY, missing values are written as NULL
+def copy_dataframe(cur, table, df):
+    buffer = io.StringIO()
+    df.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table, ', '.join(df.columns)), buffer)
+    return len(df)
+
+
+# the (key, hash) pairs of a query as dict, the keys are compared as text. Only the two columns are fetched, so this is
+# cheap compared to reading and transforming the rows
+def read_hashes(conn, query, params=None, chunk_size=CHUNK_SIZE):
+    cur = conn.cursor(name="read_hashes_{}".format(uuid.uuid4().hex), withhold=True)
+    cur.itersize = chunk_size
+    try:
+        cur.execute(query, params)
+        hashes = {str(key): record_hash for key, record_hash in cur}
+    finally:
+        cur.close()
+    instrumentation.count(rows_out=len(hashes))
+    return hashes
+
+
+# the hashes that the stage stored with its last run
+def stored_hashes(cur, stage):
+    cur.execute(HASHES_DDL)
+    cur.execute("SELECT key, record_hash FROM etl_hashes WHERE stage = %s;", (stage,))
+    return dict(cur.fetchall())
+
+
+# forget the hashes of the stage before it rebuilds its table
+def clear_hashes(cur, stage):
+    cur.execute(HASHES_DDL)
+    cur.execute("DELETE FROM etl_hashes WHERE stage = %s;", (stage,))
+
+
+# keys of the source rows that are new or changed since the last run and keys that are no longer in the source
+def diff_hashes(source, stored):
+    changed = [key for key, record_hash in source.items() if key not in stored or stored[key] != record_hash]
+    removed = [key for key in stored if key not in source]
+    return changed, removed
+
+
+# store the hashes of the rows that were written, in the same transaction as the rows
+def save_hashes(cur, stage, source, changed, removed):
+    cur.execute("DELETE FROM etl_hashes WHERE stage = %s AND key = ANY(%s);", (stage, changed + removed))
+    execute_values(cur, "INSERT INTO etl_hashes (stage, key, record_hash) VALUES %s;", [(stage, key, source[key]) for key in changed], page_size=1000)
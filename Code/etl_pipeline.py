@@ -1,26 +1,218 @@
 # this is the first lambda function for the dataset of Morrisville. Here the dataset is extracted via API from the source and loaded into a datalake (Postgres RDS) as raw data.
 
+import codecs
+import hashlib
+import io
 import json
 import os
+import time
 import psycopg2
-import pandas as pd
 import requests
-import numpy
-from psycopg2.extras import Json
+import config
+from columns import API_FIELDS, RAW_TABLE_COLUMNS as RAW_COLUMNS
+from etl_db import acquire, begin_rebuild, begin_stage, connect_metrics, finish_stage, make_dsn, out_of_time, record_batch, release, run_batch, stage_rows, swap_rebuild
+import instrumentation
+import landing_zone
 
 
-ENDPOINT = os.environ['ENDPOINT']
-DB_NAME = os.environ['DB_NAME']
-USERNAME = os.environ['USERNAME']
-PASSWORD = os.environ['PASSWORD']
+# dataset on the Morrisville OpenData portal, can be pointed to a local server serving a recorded export for testing
+API_URL = os.environ.get('API_URL', "https://opendata.townofmorrisville.org/api/explore/v2.1/catalog/datasets/pd_incident_report")
+# key of the raw table and the state table that keeps the high-water mark of the incremental loads
+WATERMARK_SOURCE = 'morrisville'
+# number of records that are handed to the loader at once
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 5000))
+# maximum number of records per request of the records API
+PAGE_SIZE = 100
+# the raw table, its columns are the ones of the API records in transforms.py and the md5 hash of the stored fields
+RAW_TABLE_DDL = ("CREATE TABLE IF NOT EXISTS morrisville (reported timestamp, occurred timestamp, weekday text, month text, year int, id int, offense text, street text, city text, state text, zip text, neighborhood text, subdivision text, tract text, zone text, district text, asst_officers text, area jsonb, record_hash text); "
+    # tables from before the hashes get the column, their rows count as changed on the next upsert
+    "ALTER TABLE morrisville ADD COLUMN IF NOT EXISTS record_hash text;")
+# high-water mark (latest date_rept) of the incremental loads
+WATERMARK_DDL = "CREATE TABLE IF NOT EXISTS etl_watermark (source text PRIMARY KEY, high_water timestamp, updated_at timestamp DEFAULT now());"
+# columns that are copied, the hash is computed while the records are written into the buffer
+COPY_COLUMNS = RAW_COLUMNS + ['record_hash']
 
 
+# connection string of the raw data lake
+def raw_dsn():
+    return make_dsn(*config.require('ENDPOINT', 'DB_NAME', 'USERNAME', 'PASSWORD'))
+
+
+# the records of a batch as parquet files of the landing zone, pandas is only needed for it
+def write_landing_zone(batch, root):
+    from transforms import raw_frame
+    landing_zone.write_partitions(raw_frame(batch), 'raw', root=root, merge=True)
+
+
+# escape a single value for the text format of COPY (NULL is written as \N)
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    text = str(value)
+    return text.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+# write the API records into a buffer and load them with a single COPY, returns the number of rows
+def copy_records(cur, table, records):
+    buffer = io.StringIO()
+    row_count = 0
+    for entry in records:
+        values = [entry.get(field) for field in API_FIELDS]
+        # the area is a dict with lat/lon and is stored as jsonb
+        values[-1] = json.dumps(entry.get('area'), sort_keys=True)
+        line = '\t'.join(copy_value(value) for value in values)
+        # the hash of the copied line changes with any of the stored fields
+        buffer.write(line + '\t' + hashlib.md5(line.encode('utf-8')).hexdigest() + '\n')
+        row_count += 1
+
+    buffer.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN".format(table, ', '.join(COPY_COLUMNS)), buffer)
+    return row_count
+
+
+# the unique index on the incident id that the upsert needs. A table that was bulk-loaded before the upsert can hold an
+# incident more than once, only its latest report is kept. Returns the number of deleted duplicates
+def create_id_key(cur):
+    cur.execute("SELECT to_regclass('morrisville_id_key') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        return 0
+    cur.execute("DELETE FROM morrisville m USING (SELECT ctid AS row_id, row_number() OVER (PARTITION BY id ORDER BY reported DESC NULLS LAST) AS n FROM morrisville WHERE id IS NOT NULL) d "
+                "WHERE m.ctid = d.row_id AND d.n > 1;")
+    removed = cur.rowcount
+    cur.execute("CREATE UNIQUE INDEX morrisville_id_key ON morrisville (id);")
+    if removed:
+        print(f"Deleted {removed} duplicate incidents from morrisville before creating its unique id")
+    return removed
+
+
+# insert new records and update changed ones (by incident id) from the staging table, then empty the staging table.
+# Records that are sent again without a change (same hash) are not written, the returned count is new and changed rows.
+# Records without incident id can't be matched with a stored record and would be inserted again by every load, they are skipped
+def upsert_staged(cur, table, staging):
+    columns = ', '.join(COPY_COLUMNS)
+    updates = ', '.join("{0} = EXCLUDED.{0}".format(column) for column in COPY_COLUMNS if column != 'id')
+    # an incident can appear twice in one batch, only the latest report is kept
+    cur.execute("INSERT INTO {0} ({2}) SELECT DISTINCT ON (id) {2} FROM {1} WHERE id IS NOT NULL ORDER BY id, reported DESC NULLS LAST ON CONFLICT (id) DO UPDATE SET {3} WHERE {0}.record_hash IS DISTINCT FROM EXCLUDED.record_hash;".format(table, staging, columns, updates))
+    upserted = cur.rowcount
+    cur.execute("TRUNCATE {};".format(staging))
+    return upserted
+
+
+# copy a batch into the staging table and merge it into the raw table (or the table of a full rebuild) in its own
+# transaction. The upsert is idempotent, so a retried batch or a batch that is read again by a resumed load doesn't
+# create duplicates
+def load_batch(batch, table=WATERMARK_SOURCE):
+    def write(cur):
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS morrisville_staging (LIKE morrisville) ON COMMIT DROP;")
+        copy_records(cur, 'morrisville_staging', batch)
+        upserted = upsert_staged(cur, table, 'morrisville_staging')
+        # the extracted records are counted, so that a resumed load knows where to continue
+        record_batch(cur, WATERMARK_SOURCE, len(batch))
+        return upserted
+    return write
+
+
+# read the high-water mark (latest date_rept) of the last load
+def get_watermark(cur, source):
+    cur.execute(WATERMARK_DDL)
+    cur.execute("SELECT high_water FROM etl_watermark WHERE source = %s;", (source,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+# store the high-water mark, this is committed together with the loaded data
+def set_watermark(cur, source, high_water):
+    cur.execute("INSERT INTO etl_watermark (source, high_water, updated_at) VALUES (%s, %s, now()) ON CONFLICT (source) DO UPDATE SET high_water = EXCLUDED.high_water, updated_at = now();", (source, high_water))
+
+
+# move the high-water mark to the latest report that is now in the raw table
+def move_watermark(cur):
+    cur.execute(WATERMARK_DDL)
+    cur.execute("SELECT max(reported) FROM morrisville;")
+    set_watermark(cur, WATERMARK_SOURCE, cur.fetchone()[0])
+
+
+# parse the records of the json export one by one while the response is downloaded, instead of holding the whole dump in memory
+def stream_export(api_url, params=None, chunk_size=65536):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    with requests.get(api_url + "/exports/json", params=params, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        buffer = ''
+        position = 0
+        started = False
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            instrumentation.count(bytes_fetched=len(chunk))
+            # keep only the part of the buffer that is not parsed yet
+            buffer = buffer[position:] + text_decoder.decode(chunk)
+            position = 0
+            while True:
+                # skip whitespace and the separators between the records
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position == len(buffer):
+                    break
+                if not started:
+                    if buffer[position] != '[':
+                        raise ValueError("The export is not a JSON array")
+                    started = True
+                    position += 1
+                    continue
+                if buffer[position] == ']':
+                    return
+                try:
+                    record, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # the record is not complete yet, read the next chunk
+                    break
+                yield record
+    raise ValueError("The export ended before the end of the JSON array")
+
+
+# page through the records API with limit/offset, a resumed load starts after the records it has loaded already
+def page_records(api_url, params=None, page_size=PAGE_SIZE, offset=0):
+    while True:
+        page_params = dict(params or {}, order_by='inci_id', limit=page_size, offset=offset)
+        response = requests.get(api_url + "/records", params=page_params, timeout=60)
+        response.raise_for_status()
+        instrumentation.count(bytes_fetched=len(response.content))
+        results = response.json().get('results', [])
+        yield from results
+        offset += len(results)
+        if len(results) < page_size:
+            return
+
+
+# get the records from the API, either streamed from the json export or paged through the records API. The export
+# can't skip records, it is read from the start and the records that didn't change are not written again
+def extract_records(api_url, mode='export', params=None, offset=0):
+    if mode == 'records':
+        return page_records(api_url, params, offset=offset)
+    if mode == 'export':
+        return stream_export(api_url, params)
+    raise ValueError(f"Unknown extraction mode: {mode}")
+
+
+# group the records into lists of a fixed size so that only one batch is in memory at a time
+def iter_batches(records, batch_size=BATCH_SIZE):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def lambda_handler(event, context):
+    event = event or {}
+    run = instrumentation.start_run('etl_pipeline')
+    
     # Connect to the postgres database
+    run.enter('connect')
     try:
-        conn = psycopg2.connect("host={} dbname={} user={} password={}".format(ENDPOINT, DB_NAME, USERNAME, PASSWORD))
+        conn = acquire(raw_dsn())
 
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
@@ -34,70 +226,96 @@ def lambda_handler(event, context):
         print(e)
         
 
-    # Auto commit
-    conn.set_session(autocommit=True)
+    # every batch is committed on its own, a load that is interrupted (e.g. by the timeout of the lambda function) or fails
+    # is resumed by the next invocation
+    conn.set_session(autocommit=False)
     
     
     # Get data from API
-    # Define the API URL
-    api_url = "https://opendata.townofmorrisville.org/api/explore/v2.1/catalog/datasets/pd_incident_report/exports/json"
-
-    try:
-        # Send a GET request to the API
-        response = requests.get(api_url)
-    
-        # Check if the request was successful (status code 200)
-        if response.status_code == 200:
-            # Get the content (JSON data) from the response
-            json_data = response.json()
-        else:
-            # If the request was not successful, print an error message
-            print(f"Request failed with status code: {response.status_code}")
-    except psycopg2.Error as e:
-        print(f"An error occurred: {str(e)}")
+    # the records are streamed in batches while they are loaded, the mode and url can be set in the event
+    api_url = event.get('api_url', API_URL)
+    extract_mode = event.get('extract_mode', 'export')
+    batch_size = int(event.get('batch_size', BATCH_SIZE))
+    # 'incremental' only requests records reported since the last load and upserts them, 'full' reloads the whole table
+    load_mode = event.get('mode', 'incremental')
+    max_batches = event.get('max_batches')
+    # the records are also written as parquet files into the landing zone if one is configured
+    landing_root = event.get('landing_zone', landing_zone.LANDING_ZONE_PATH)
         
     #Create table and load data into database   
+    result = {'mode': load_mode, 'rows': 0, 'batches': 0, 'finished': False, 'seconds': 0.0, 'rows_per_sec': 0.0}
     try:
-        
-        # Delete all records from the "morrisville" table
-        cur.execute("DELETE FROM morrisville")
+        start_time = time.perf_counter()
+        run.enter('load')
         
         #Create new table if it doesn't already exist
-        cur.execute("CREATE TABLE IF NOT EXISTS morrisville (reported timestamp, occurred timestamp, weekday text, month text, year int, id int, offense text, street text, city text, state text, zip text, neighborhood text, subdivision text, tract text, zone text, district text, asst_officers text, area jsonb);")
+        cur.execute(RAW_TABLE_DDL)
+        
+        # the incident id is the key for the upsert of the loads
+        create_id_key(cur)
+        
+        if load_mode not in ('incremental', 'full'):
+            raise ValueError(f"Unknown load mode: {load_mode}")
+        load_mode, resumed = begin_stage(cur, WATERMARK_SOURCE, load_mode)
+        result['mode'] = load_mode
         
+        params = None
+        table = WATERMARK_SOURCE
+        if load_mode == 'full':
+            # the records are loaded into a new table that replaces "morrisville" when the load finished, until then the
+            # old table is read
+            table, started = begin_rebuild(cur, WATERMARK_SOURCE, resumed)
+            resumed = not started
+            if started and landing_root:
+                landing_zone.clear_dataset('raw', root=landing_root)
+        elif load_mode == 'incremental':
+            # only request the records reported since the last load, the first load gets everything. The high-water mark
+            # only moves when a load finishes, so a resumed load requests the same records
+            high_water = get_watermark(cur, WATERMARK_SOURCE)
+            params = {'where': "date_rept >= date'{}'".format(high_water.isoformat())} if high_water else None
+        # the records API continues after the records that the interrupted load has committed
+        offset = stage_rows(cur, WATERMARK_SOURCE) if resumed and extract_mode == 'records' else 0
         conn.commit()
+        
+        # the batches are copied into a staging table and merged into the raw table from there
+        row_count = 0
+        finished = True
+        for batch in run.iterate(iter_batches(extract_records(api_url, extract_mode, params, offset), batch_size), 'extract'):
+            run.count('extract', rows_out=len(batch))
+            upserted, conn = run_batch(conn, load_batch(batch, table))
+            run.count(rows_in=len(batch), rows_out=upserted)
+            row_count += upserted
+            result['batches'] += 1
+            if landing_root:
+                write_landing_zone(batch, landing_root)
+            # leave the rest to the next invocation
+            if out_of_time(context) or (max_batches is not None and result['batches'] >= int(max_batches)):
+                finished = False
+                break
+        
+        # move the high-water mark to the latest report that is now in the table
+        run.enter('post_sql')
+        if finished:
+            def finish(cur):
+                if load_mode == 'full':
+                    swap_rebuild(cur, WATERMARK_SOURCE)
+                move_watermark(cur)
+                finish_stage(cur, WATERMARK_SOURCE)
+            _, conn = run_batch(conn, finish)
+        
+        elapsed = time.perf_counter() - start_time
+        result.update({'rows': row_count, 'finished': finished, 'seconds': round(elapsed, 3), 'rows_per_sec': round(row_count / elapsed, 1) if elapsed > 0 else 0.0})
+        print(f"Loaded {row_count} rows into morrisville in {elapsed:.2f}s ({result['rows_per_sec']} rows/sec)" + ("" if finished else ", the next invocation resumes"))
     
-        # Insert the data into the PostgreSQL table
-        for entry in json_data:
-            entry['area'] = json.dumps(entry['area'])
-            cur.execute("INSERT INTO morrisville (reported, occurred, weekday, month, year, id, offense, street, city, state, zip, neighborhood, subdivision, tract, zone, district, asst_officers, area) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (
-                entry['date_rept'],
-                entry['date_occu'],
-                entry['dow1'],
-                entry['monthstamp'],
-                entry['yearstamp'],
-                entry['inci_id'],
-                entry['offense'],
-                entry['street'],
-                entry['city'],
-                entry['state'],
-                entry['zip'],
-                entry['neighborhd'],
-                entry['subdivisn'],
-                entry['tract'],
-                entry['zone'],
-                entry['district'],
-                entry['asst_offcr'],
-                entry['area']
-            ))
-    
-    except psycopg2.Error as e:
+    except (psycopg2.Error, requests.RequestException, ValueError, OSError) as e:
+        # the batches that were committed are kept, the next invocation resumes after them
+        conn.rollback()
         print(f"An error occurred: {str(e)}")
 
-    # Commit the changes to the database
-    conn.commit()
-
     # Close the cursor and the database connection
     cur.close()
-    conn.close()
-        
+    release(conn)
+    
+    result['connections'] = connect_metrics()
+    result['metrics'] = instrumentation.finish_run(run)
+    return result
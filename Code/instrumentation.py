@@ -0,0 +1,124 @@
+# metrics of a lambda run per phase (connect, extract, transform, load, post_sql for the DDL, indexes, updates and commits
+# around the load): wall time, rows in and out, SQL statements, commits, fetched bytes, retried batches and the peak memory of the
+# process. They are logged as one JSON line per phase and returned in the result of the handler. The statements and commits are counted by the connections of etl_db, the rows by the handlers.
+
+import json
+import resource
+import threading
+import time
+
+
+# counters of every phase
+COUNTERS = ['rows_in', 'rows_out', 'statements', 'commits', 'bytes_fetched', 'retries']
+
+# runs that are recorded at the moment, the last one gets the counts (a handler can be called by the pipeline)
+_runs = []
+_lock = threading.Lock()
+
+
+# high-water mark of the resident memory of the process in MB (ru_maxrss is in KB on Linux). It covers the whole lifetime of
+# the process, so in a warm lambda container or in a later stage of pipeline.py it can be the peak of an earlier run
+def process_peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class RunMetrics:
+    def __init__(self, function):
+        self.function = function
+        self.phases = {}
+        self.start_time = time.perf_counter()
+        self.start_peak = process_peak_rss_mb()
+        # every thread has its own current phase, the time of phases that run in parallel threads is added up
+        self._local = threading.local()
+
+    def _metrics(self, phase):
+        metrics = self.phases.get(phase)
+        if metrics is None:
+            metrics = self.phases[phase] = dict({'seconds': 0.0, 'process_peak_rss_mb': None}, **{counter: 0 for counter in COUNTERS})
+        return metrics
+
+    @property
+    def current(self):
+        return getattr(self._local, 'phase', None)
+
+    # end the current phase of the thread and start the next one (None only ends the current phase)
+    def enter(self, phase):
+        now = time.perf_counter()
+        with _lock:
+            if self.current is not None:
+                metrics = self._metrics(self.current)
+                metrics['seconds'] += now - self._local.started
+                metrics['process_peak_rss_mb'] = process_peak_rss_mb()
+            if phase is not None:
+                self._metrics(phase)
+        self._local.phase = phase
+        self._local.started = now
+
+    # iterate over a generator (e.g. the chunks of a query) and count the time of fetching the items to the phase
+    def iterate(self, items, phase):
+        items = iter(items)
+        while True:
+            previous = self.current
+            self.enter(phase)
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.enter(previous)
+            yield item
+
+    # add to the counters of the given phase or the current phase of the thread
+    def count(self, phase=None, **values):
+        with _lock:
+            metrics = self._metrics(phase or self.current or 'other')
+            for counter, value in values.items():
+                metrics[counter] += value
+
+    # the growth of the process peak is the memory that the run needed above the peak before it, 0 when it stayed below
+    def result(self):
+        with _lock:
+            phases = {phase: dict(metrics, seconds=round(metrics['seconds'], 4)) for phase, metrics in self.phases.items()}
+        peak = process_peak_rss_mb()
+        return {'seconds': round(time.perf_counter() - self.start_time, 4), 'process_peak_rss_mb': peak, 'peak_rss_growth_mb': round(peak - self.start_peak, 1), 'phases': phases}
+
+
+# start recording a run of the function, a run of the same function that wasn't finished (the handler raised) is dropped
+def start_run(function):
+    run = RunMetrics(function)
+    with _lock:
+        _runs[:] = [other for other in _runs if other.function != function]
+        _runs.append(run)
+    return run
+
+
+# end the run, log one JSON line per phase and one for the whole run and return the metrics
+def finish_run(run):
+    run.enter(None)
+    with _lock:
+        if run in _runs:
+            _runs.remove(run)
+    result = run.result()
+    for phase, metrics in result['phases'].items():
+        print(json.dumps(dict({'function': run.function, 'phase': phase}, **metrics)))
+    print(json.dumps({'function': run.function, 'phase': 'total', 'seconds': result['seconds'], 'process_peak_rss_mb': result['process_peak_rss_mb'], 'peak_rss_growth_mb': result['peak_rss_growth_mb']}))
+    return result
+
+
+def current_run():
+    with _lock:
+        return _runs[-1] if _runs else None
+
+
+# add to the counters of the current run, nothing is recorded outside of a run
+def count(phase=None, **values):
+    run = current_run()
+    if run is not None:
+        run.count(phase, **values)
+
+
+# start the phase in the current run
+def enter(phase):
+    run = current_run()
+    if run is not None:
+        run.enter(phase)
@@ -0,0 +1,142 @@
+# optional file-based landing zone for the raw and the cleaned morrisville data. Each dataset is stored as parquet files partitioned by
+# year and month of the occurred timestamp (<root>/<dataset>/occurred_year=2024/occurred_month=5/part-0.parquet), so that a stage
+# can read single months and only the columns it needs. pandas and pyarrow are only imported when the landing zone is used.
+
+import os
+import shutil
+
+
+# root directory of the landing zone on the local filesystem, the landing zone is not used when it isn't set
+LANDING_ZONE_PATH = os.environ.get('LANDING_ZONE_PATH')
+
+PARTITION_COLUMNS = ['occurred_year', 'occurred_month']
+# rows without occurred timestamp are kept in this partition
+UNKNOWN_PARTITION = 0
+
+# key of the records (new records replace older ones with the same key) and the column types of the datasets, other columns are text
+DATASETS = {
+    'raw': {'key': 'id', 'types': {'reported': 'timestamp', 'occurred': 'timestamp', 'year': 'int', 'id': 'int', 'area': 'point'}},
+    'clean': {'key': None, 'types': {'occurred': 'timestamp', 'rounded_timestamp': 'timestamp', 'year': 'int', 'latitude': 'float', 'longitude': 'float'}}
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("The landing zone needs pyarrow (pip install pyarrow)") from e
+    return pa, pq
+
+
+def _arrow_type(pa, kind):
+    if kind == 'timestamp':
+        return pa.timestamp('us')
+    if kind == 'int':
+        return pa.int64()
+    if kind == 'float':
+        return pa.float64()
+    if kind == 'point':
+        return pa.struct([('lat', pa.float64()), ('lon', pa.float64())])
+    return pa.string()
+
+
+def _float_or_none(value):
+    return None if value is None else float(value)
+
+
+# bring the columns into the types of the dataset, so that all partition files have the same schema
+def _conform(df, types):
+    import pandas as pd
+    df = df.copy()
+    for column in df.columns:
+        kind = types.get(column, 'text')
+        if kind == 'timestamp':
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+        elif kind == 'int':
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype('Int64')
+        elif kind == 'float':
+            df[column] = pd.to_numeric(df[column], errors='coerce').astype(float)
+        elif kind == 'point':
+            df[column] = [{'lat': _float_or_none(area.get('lat')), 'lon': _float_or_none(area.get('lon'))} if isinstance(area, dict) else None for area in df[column]]
+        else:
+            df[column] = [None if value is None or (isinstance(value, float) and value != value) else str(value) for value in df[column]]
+    return df
+
+
+def dataset_path(dataset, root=None):
+    return os.path.join(root or LANDING_ZONE_PATH, dataset)
+
+
+def partition_path(dataset, year, month, root=None):
+    return os.path.join(dataset_path(dataset, root), 'occurred_year={}'.format(year), 'occurred_month={}'.format(month))
+
+
+# remove a whole dataset before it is written again, or only the given (year, month) partitions
+def clear_dataset(dataset, months=None, root=None):
+    if months is None:
+        shutil.rmtree(dataset_path(dataset, root), ignore_errors=True)
+        return
+    for year, month in months:
+        shutil.rmtree(partition_path(dataset, year, month, root), ignore_errors=True)
+
+
+# write the rows into the partitions of their month. With merge the rows are added to the existing file of the month
+# (replacing rows with the same key), otherwise the file of the month is replaced. Returns the written (year, month) partitions
+def write_partitions(df, dataset, root=None, merge=False):
+    import pandas as pd
+    pa, pq = _pyarrow()
+    spec = DATASETS[dataset]
+    occurred = pd.to_datetime(df['occurred'], errors='coerce')
+    years = occurred.dt.year.fillna(UNKNOWN_PARTITION).astype(int)
+    months = occurred.dt.month.fillna(UNKNOWN_PARTITION).astype(int)
+
+    written = []
+    for (year, month), part in df.groupby([years, months], sort=True):
+        directory = partition_path(dataset, year, month, root)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'part-0.parquet')
+        if merge and os.path.exists(path):
+            part = pd.concat([pq.read_table(path).to_pandas(), part], ignore_index=True)
+            if spec['key']:
+                part = part.drop_duplicates(subset=spec['key'], keep='last')
+        part = _conform(part, spec['types'])
+        schema = pa.schema([(column, _arrow_type(pa, spec['types'].get(column, 'text'))) for column in part.columns])
+        table = pa.Table.from_pandas(part, schema=schema, preserve_index=False, safe=False)
+        # write next to the file and replace it, so that readers never see a half written file (hidden files are not read)
+        temporary_path = os.path.join(directory, '.part-0.parquet.tmp')
+        pq.write_table(table, temporary_path, compression='snappy')
+        os.replace(temporary_path, path)
+        written.append((int(year), int(month)))
+    return written
+
+
+# read a dataset back with column projection. Only the partitions of the given (year, month) list and/or the months
+# from since=(year, month) on are read
+def read_partitions(dataset, columns=None, months=None, since=None, root=None):
+    import pandas as pd
+    _pyarrow()
+    import pyarrow.dataset as ds
+    path = dataset_path(dataset, root)
+    if not os.path.isdir(path):
+        return pd.DataFrame(columns=columns)
+
+    year = ds.field('occurred_year')
+    month = ds.field('occurred_month')
+    partition_filter = None
+    if months:
+        for selected_year, selected_month in months:
+            condition = (year == selected_year) & (month == selected_month)
+            partition_filter = condition if partition_filter is None else partition_filter | condition
+    if since:
+        condition = (year > since[0]) | ((year == since[0]) & (month >= since[1]))
+        partition_filter = condition if partition_filter is None else partition_filter & condition
+
+    data = ds.dataset(path, format='parquet', partitioning='hive')
+    return data.to_table(columns=columns, filter=partition_filter).to_pandas()
+
+
+# split a dataframe into chunks of the given size
+def iter_chunks(df, chunk_size):
+    for start in range(0, len(df), chunk_size):
+        yield df.iloc[start:start + chunk_size]
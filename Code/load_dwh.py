@@ -1,159 +1,230 @@
-# in this function both crime datasets are merged together so that it is later on easier to transfer into the datawarehouse.
+# in this function the crime datasets of the cities in sources.py are merged together so that it is later on easier to transfer into the datawarehouse.
 
-import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 import psycopg2
-import pandas as pd
-import numpy as np
-from psycopg2.extras import Json
+from etl_db import REBUILD_SUFFIX, acquire, begin_stage, clear_hashes, connect_metrics, copy_dataframe, diff_hashes, finish_stage, out_of_time, record_batch, release, reset_stage, run_batch, save_hashes, stored_hashes
+import instrumentation
+import landing_zone
+from sources import SOURCES, LandingZoneSource, morrisville_dsn
 
 
-MORR_ENDPOINT = os.environ['MORR_ENDPOINT']
-MORR_DB = os.environ['MORR_DB']
-OV_USERNAME = os.environ['OV_USERNAME']
-OV_PASSWORD = os.environ['OV_PASSWORD']
-CAR_ENDPOINT = os.environ['CAR_ENDPOINT']
-CAR_DB = os.environ['CAR_DB']
-AS_USERNAME = os.environ['AS_USERNAME']
-AS_PASSWORD = os.environ['AS_PASSWORD']
+# the merged table, its columns are copied in the order of TBL_CRIMES_COLUMNS. source, source_key and record_hash
+# identify the incident in its source and the content it was loaded with. Every source has its own partition, so the
+# sources are loaded and replaced independently of each other
+TBL_CRIMES_DDL = "CREATE TABLE IF NOT EXISTS tbl_crimes (incident_id SERIAL, datetime timestamp, rounded_time timestamp, weekday text, crime_type text, street text, city text, subdivision text, district text, latitude float, longitude float, source text NOT NULL, source_key text, record_hash text, PRIMARY KEY (incident_id, source)) PARTITION BY LIST (source);"
+# prefix of the stages of the sources in the hash and load state tables of the morrisville database
+HASH_STAGE = 'merge_'
+# maximum number of sources that are loaded at the same time
+MERGE_WORKERS = int(os.environ.get('MERGE_WORKERS', 8))
 
-def lambda_handler(event, context):
-    # Connect to the morrisville database
-    try:
-        mor_conn = psycopg2.connect("host={} dbname={} user={} password={}".format(MORR_ENDPOINT, MORR_DB, OV_USERNAME, OV_PASSWORD))
 
-    except psycopg2.Error as e:
-        print("Error: Could not make connection to the Postgres database")
-        print(e)
+# the partition of tbl_crimes that holds the incidents of a source
+def partition_name(name):
+    return 'tbl_crimes_' + name
+
+
+# create tbl_crimes with a partition for every source. A table from before the partitions is replaced and the progress of
+# the sources is reset, so that all of them are loaded again. Returns whether the table was replaced
+def create_tbl_crimes(cur, sources=SOURCES):
+    cur.execute("SELECT to_regclass('tbl_crimes') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('tbl_crimes'));")
+    replaced = cur.fetchone()[0]
+    if replaced:
+        cur.execute("DROP TABLE tbl_crimes;")
+        for source in sources:
+            reset_stage(cur, HASH_STAGE + source.name)
+    cur.execute(TBL_CRIMES_DDL)
+    for source in sources:
+        cur.execute("CREATE TABLE IF NOT EXISTS {} PARTITION OF tbl_crimes FOR VALUES IN (%s);".format(partition_name(source.name)), (source.name,))
+    cur.execute("CREATE INDEX IF NOT EXISTS tbl_crimes_source_idx ON tbl_crimes (source, source_key);")
+    return replaced
+
+
+# start the rebuild of the partition of a source: a table like the partition that is loaded batch by batch and swapped in
+# by swap_partition. The check on the source lets the attach skip the scan of the rows. A resumed rebuild continues with
+# its table. Returns the name of the table and whether it was started anew
+def begin_partition_rebuild(cur, name, resumed=False):
+    rebuild = partition_name(name) + REBUILD_SUFFIX
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (rebuild,))
+    if resumed and cur.fetchone()[0]:
+        return rebuild, False
+    cur.execute("DROP TABLE IF EXISTS {};".format(rebuild))
+    cur.execute("CREATE TABLE {0} (LIKE {1} INCLUDING ALL, CHECK (source = %s));".format(rebuild, partition_name(name)), (name,))
+    return rebuild, True
+
+
+# replace the partition of a source with its rebuild, its indexes are named after the partition again
+def swap_partition(cur, name):
+    partition = partition_name(name)
+    rebuild = partition + REBUILD_SUFFIX
+    cur.execute("ALTER TABLE tbl_crimes DETACH PARTITION {};".format(partition))
+    cur.execute("DROP TABLE {};".format(partition))
+    cur.execute("ALTER TABLE {} RENAME TO {};".format(rebuild, partition))
+    cur.execute("ALTER TABLE tbl_crimes ATTACH PARTITION {} FOR VALUES IN (%s);".format(partition), (name,))
+    cur.execute("SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = %s::regclass AND starts_with(c.relname, %s);", (partition, rebuild))
+    for (index,) in cur.fetchall():
+        cur.execute("ALTER INDEX {} RENAME TO {};".format(index, partition + index[len(rebuild):]))
 
+
+# replace the incidents of a mapped chunk in the partition of the source (or its rebuild) and store their hashes, the
+# changed incidents get a new incident id
+def load_chunk(source, source_hashes, df_crimes, partition):
+    stage = HASH_STAGE + source.name
+    def write(cur):
+        if source.tracked:
+            keys = df_crimes['source_key'].tolist()
+            cur.execute("DELETE FROM {} WHERE source_key = ANY(%s);".format(partition), (keys,))
+            save_hashes(cur, stage, source_hashes, keys, [])
+        #delete when date is missing
+        copied = copy_dataframe(cur, partition, df_crimes[df_crimes['rounded_time'].notna()])
+        record_batch(cur, stage, copied)
+        return copied
+    return write
+
+
+# merge one source into its partition on its own connections: compare the hashes with the ones of the last run, delete the
+# removed incidents and load the new and changed ones batch by batch. Every source keeps its own progress, so a slow or
+# failing source doesn't hold up the others and a run that didn't finish is resumed per source
+def load_source(source, merge_mode, context=None, max_batches=None):
+    stage = HASH_STAGE + source.name
+    partition = partition_name(source.name)
+    result = {'mode': merge_mode, 'rows': 0, 'changed': 0, 'removed': 0, 'batches': 0, 'finished': False}
+    conn = None
     try:
-        mor_cur = mor_conn.cursor()
-    except psycopg2.Error as e:
-        print("Error: Could not get curser to the Database")
-        print(e)
-        
-        
-    # Connect to the cary database
+        conn = acquire(morrisville_dsn())
+        instrumentation.enter('load')
+        with conn.cursor() as cur:
+            merge_mode, resumed = begin_stage(cur, stage, merge_mode)
+            result['mode'] = merge_mode
+            # a full run and a source without hashes (replaced completely by every run) load a new partition that replaces
+            # the old one when the run finished, until then the old partition is read
+            rebuild = merge_mode == 'full' or not source.tracked
+            if rebuild:
+                partition, started = begin_partition_rebuild(cur, source.name, resumed and source.tracked)
+                if started:
+                    clear_hashes(cur, stage)
+            else:
+                # rows without key (e.g. the checkpoint of pipeline.py) can't be matched with the source and are loaded again
+                cur.execute("DELETE FROM {} WHERE source_key IS NULL;".format(partition))
+        conn.commit()
+
+        # the batches of a resumed run that were committed already have the new hashes and are skipped
+        source_hashes = {}
+        if source.tracked:
+            instrumentation.enter('extract')
+            source_hashes = source.read_hashes()
+            instrumentation.enter('load')
+            with conn.cursor() as cur:
+                changed, removed = diff_hashes(source_hashes, stored_hashes(cur, stage))
+            conn.commit()
+            result.update({'changed': len(changed), 'removed': len(removed)})
+
+            # the incidents that are no longer in the source
+            def delete_removed(cur):
+                cur.execute("DELETE FROM {} WHERE source_key = ANY(%s);".format(partition), (removed,))
+                save_hashes(cur, stage, source_hashes, [], removed)
+                record_batch(cur, stage, 0)
+            if removed:
+                _, conn = run_batch(conn, delete_removed)
+            chunks = source.read_changed(changed, len(source_hashes))
+        else:
+            chunks = source.read()
+
+        finished = True
+        instrumentation.enter('extract')
+        try:
+            for chunk in chunks:
+                instrumentation.enter('transform')
+                df_crimes = source.map(chunk)
+                instrumentation.count(rows_in=len(chunk), rows_out=len(df_crimes))
+                instrumentation.enter('load')
+                copied, conn = run_batch(conn, load_chunk(source, source_hashes, df_crimes, partition))
+                instrumentation.count(rows_in=len(df_crimes), rows_out=copied)
+                result['rows'] += copied
+                result['batches'] += 1
+                # leave the rest to the next invocation
+                if out_of_time(context) or (max_batches is not None and result['batches'] >= int(max_batches)):
+                    finished = False
+                    break
+                instrumentation.enter('extract')
+        finally:
+            # a stopped read closes its cursor and gives its connection back
+            chunks.close()
+
+        instrumentation.enter('post_sql')
+        if finished:
+            def finish(cur):
+                if rebuild:
+                    swap_partition(cur, source.name)
+                finish_stage(cur, stage)
+            _, conn = run_batch(conn, finish)
+        result['finished'] = finished
+    except (psycopg2.Error, ValueError, OSError) as e:
+        # the batches that were committed are kept, the next invocation resumes after them
+        if conn is not None and not conn.closed:
+            conn.rollback()
+        result['error'] = str(e)
+        print(f"An error occurred while merging {source.name}: {str(e)}")
+    finally:
+        instrumentation.enter(None)
+        release(conn)
+    return result
+
+
+def lambda_handler(event, context):
+    event = event or {}
+    run = instrumentation.start_run('load_dwh')
+
+    # With a landing zone the morrisville incidents are read from its parquet files, they have no hashes and are all replaced.
+    # "sources" (list of names) only merges these cities
+    landing_root = event.get('landing_zone', landing_zone.LANDING_ZONE_PATH)
+    sources = [LandingZoneSource(source, landing_root) if landing_root and source.name == 'morrisville' else source for source in SOURCES]
+    if event.get('sources'):
+        sources = [source for source in sources if source.name in event['sources']]
+    # 'incremental' only loads the incidents whose hash is new or changed since the last run, 'full' rebuilds the partitions.
+    # A run that didn't finish (e.g. a timeout of the lambda function) is resumed by the next invocation
+    merge_mode = event.get('mode', 'incremental')
+    max_batches = event.get('max_batches')
+
+    # Connect to the morrisville database, the merged table is written there
+    run.enter('connect')
     try:
-        car_conn = psycopg2.connect("host={} dbname={} user={} password={}".format(CAR_ENDPOINT, CAR_DB, AS_USERNAME, AS_PASSWORD))
+        mor_conn = acquire(morrisville_dsn())
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
         print(e)
-        
+
     try:
-        car_cur = car_conn.cursor()
+        mor_cur = mor_conn.cursor()
     except psycopg2.Error as e:
         print("Error: Could not get curser to the Database")
         print(e)
-    
-
-    # Auto commit
-    mor_conn.set_session(autocommit=True)
-    car_conn.set_session(autocommit=True)
-    
-    
-    #Get data from morrisville database
-    
-    try:
-        mor_cur.execute("SELECT * FROM morrisville WHERE occurred >= '2021-01-01';")
-    except psycopg2.Error as e:
-        print(f"Error executing the query. Error: {e}")
-        
-    #load the data into a dataframe for the cleanup
-    columns1 = [desc[0] for desc in mor_cur.description]
-    data_raw1 = mor_cur.fetchall()
-    df_mor = pd.DataFrame(data_raw1, columns=columns1)
-
-    #Get data from cary database
-    try:
-        car_cur.execute("SELECT * FROM clean_data_gold_2;")
-    except psycopg2.Error as e:
-        print(f"Error executing the query. Error: {e}")
-        
-    #load the data into a dataframe for the cleanup
-    columns2 = [desc[0] for desc in car_cur.description]
-    data_raw2 = car_cur.fetchall()
-    df_car = pd.DataFrame(data_raw2, columns=columns2)
-        
-
-    #create new table merging both incident datasets and adding id to it
-    #first get data from morrisville and add to new table
+
+    mor_conn.set_session(autocommit=False)
+
+    result = {'mode': merge_mode, 'sources': {}, 'finished': False}
     try:
-        # Delete "morrisville" table
-        mor_cur.execute("DROP TABLE IF EXISTS tbl_crimes;")
+        run.enter('load')
+        if merge_mode not in ('incremental', 'full'):
+            raise ValueError(f"Unknown merge mode: {merge_mode}")
+        result['replaced'] = create_tbl_crimes(mor_cur)
         mor_conn.commit()
-        
-        mor_cur.execute("CREATE TABLE IF NOT EXISTS tbl_crimes (incident_id SERIAL PRIMARY KEY, datetime timestamp, rounded_time timestamp, weekday text, crime_type text, street text, city text, subdivision text, district text, latitude float, longitude float);")
-        mor_conn.commit()
-    
-        # Insert the data into the PostgreSQL table
-        for index, row in df_mor.iterrows():
-            occurred_value = row['occurred']
-            rounded_value = row['rounded_timestamp']
-            if pd.isna(occurred_value):
-                occurred_value = None  # Set to None for proper handling by psycopg2
-            if pd.isna(rounded_value):
-                rounded_value = None  # Set to None for proper handling by psycopg2
-            query = "INSERT INTO tbl_crimes (incident_id, datetime, rounded_time, weekday, crime_type, street, city, subdivision, district, latitude, longitude) VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
-            values = (
-                occurred_value,
-                rounded_value,
-                row['weekday'],
-                row['offense'],
-                row['street'],
-                row['city'],
-                row['subdivision'],
-                row['district'],
-                row['longitude'],
-                row['latitude']
-            )
-            try:
-                mor_cur.execute(query, values)
-            except psycopg2.Error as e:
-                print(f"An error occurred: {str(e)}")
-    
-    except psycopg2.Error as e:
+    except (psycopg2.Error, ValueError) as e:
+        mor_conn.rollback()
+        sources = []
         print(f"An error occurred: {str(e)}")
-    
-    #get data from cary and add to new table
-    try:
-        # Insert the data into the PostgreSQL table
-        for index, row in df_car.iterrows():
-            date_str = row['date_from'].strftime('%Y-%m-%d')
-            time_str = row['from_time'].strftime('%H:%M:%S')
-            rounded_str = row['from_time_rounded'].strftime('%H:%M:%S')
-            datetime_value = date_str + ' ' + time_str
-            rounded_time_value = date_str + ' ' + rounded_str
-            query = "INSERT INTO tbl_crimes (incident_id, datetime, rounded_time, weekday, crime_type, street, city, subdivision, district, latitude, longitude) VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
-            values = (
-                datetime_value,
-                rounded_time_value,
-                row['crimeday'],
-                row['crime_type'],
-                row['geocode'],
-                'CARY',
-                row['subdivisn_id'],
-                row['district'],
-                row['lat'],
-                row['lon']
-            )
-            try:
-                mor_cur.execute(query, values)
-            except psycopg2.Error as e:
-                print(f"An error occurred: {str(e)}")
-    
-    except psycopg2.Error as e:
-        print(f"An error occurred: {str(e)}")
-        
-    #delete when date is missing
-    delete_query = "DELETE FROM tbl_crimes WHERE rounded_time IS NULL;"
-    mor_cur.execute(delete_query)
-    mor_conn.commit()
-    
 
     #close connection to the first database
     mor_cur.close()
-    mor_conn.close()
-    
-    car_cur.close()
-    car_conn.close()
+    release(mor_conn)
+
+    # every source is read, mapped and loaded into its partition in its own thread with its own connections
+    if sources:
+        with ThreadPoolExecutor(max_workers=min(len(sources), MERGE_WORKERS)) as executor:
+            futures = {source.name: executor.submit(load_source, source, merge_mode, context, max_batches) for source in sources}
+        result['sources'] = {name: future.result() for name, future in futures.items()}
+        result['finished'] = all(source_result['finished'] for source_result in result['sources'].values())
+    print(f"Merged {sum(source_result['rows'] for source_result in result['sources'].values())} rows into tbl_crimes: {result['sources']}")
+
+    result.update({'connections': connect_metrics(), 'metrics': instrumentation.finish_run(run)})
+    return result
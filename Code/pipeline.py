@@ -0,0 +1,223 @@
+# this function runs all stages of the crime data pipeline in one process. The data is handed from one stage to the next as dataframe,
+# the intermediate tables (raw data lake, cleaned morrisville data, tbl_crimes) are only written when they are requested as checkpoints.
+# A run can be limited to a range of stages and can start from the checkpoint of the stage before.
+
+import time
+import psycopg2
+import pandas as pd
+import requests
+import create_dwh
+import dwh_aggregates
+import etl_cleanup
+import etl_pipeline
+import instrumentation
+import load_dwh
+import sources
+import weather_dwh
+from etl_db import CHUNK_SIZE, acquire, connect_metrics, copy_dataframe, read_chunks, release, reset_stage
+
+
+STAGES = ['extract', 'clean', 'merge', 'dwh', 'weather', 'aggregates']
+
+
+# connection strings of the databases, the same variables are used as in the single lambda functions
+raw_dsn = etl_pipeline.raw_dsn
+clean_dsn = etl_cleanup.clean_dsn
+merged_dsn = sources.morrisville_dsn
+dwh_dsn = create_dwh.dwh_dsn
+
+
+# read a whole table (the checkpoint of an earlier run) into one dataframe
+def read_checkpoint(dsn, table, columns, where=''):
+    conn = acquire(dsn)
+    conn.autocommit = True
+    try:
+        frames = list(read_chunks(conn, "SELECT {} FROM {} {};".format(', '.join(columns), table, where)))
+    finally:
+        release(conn)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
+
+
+# replace the content of a checkpoint table in one transaction, write(cur) loads the new rows. ddl is the statement that
+# creates the table or a function that creates it with the cursor
+def write_checkpoint(dsn, table, ddl, write):
+    conn = acquire(dsn)
+    try:
+        with conn.cursor() as cur:
+            if callable(ddl):
+                ddl(cur)
+            else:
+                cur.execute(ddl)
+            cur.execute("DELETE FROM {};".format(table))
+            write(cur)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    finally:
+        release(conn)
+
+
+# stage 1: get the morrisville records from the API
+def run_extract(data, checkpoint, event):
+    instrumentation.enter('extract')
+    records = list(etl_pipeline.extract_records(event.get('api_url', etl_pipeline.API_URL), event.get('extract_mode', 'export')))
+    instrumentation.count(rows_out=len(records))
+    if checkpoint:
+        instrumentation.enter('load')
+        def create_raw(cur):
+            cur.execute(etl_pipeline.RAW_TABLE_DDL)
+            etl_pipeline.create_id_key(cur)
+        # the records are upserted like the loads of etl_pipeline.py (an incident that is exported twice is kept once) and the
+        # high-water mark moves to the latest report, so that the next incremental run of etl_pipeline.py continues from there
+        def write_raw(cur):
+            reset_stage(cur, etl_pipeline.WATERMARK_SOURCE)
+            etl_pipeline.load_batch(records)(cur)
+            etl_pipeline.move_watermark(cur)
+        write_checkpoint(raw_dsn(), 'morrisville', create_raw, write_raw)
+    instrumentation.enter('transform')
+    from transforms import raw_frame
+    df_raw = raw_frame(records)
+    instrumentation.count(rows_in=len(records), rows_out=len(df_raw))
+    return df_raw
+
+
+# stage 2: clean up the raw morrisville data
+def run_clean(df_raw, checkpoint, event):
+    if df_raw is None:
+        instrumentation.enter('extract')
+        df_raw = read_checkpoint(raw_dsn(), 'morrisville', etl_cleanup.RAW_COLUMNS)
+    instrumentation.enter('transform')
+    df_clean = etl_cleanup.clean_raw(df_raw[etl_cleanup.RAW_COLUMNS])
+    instrumentation.count(rows_in=len(df_raw), rows_out=len(df_clean))
+    if checkpoint:
+        instrumentation.enter('load')
+        write_checkpoint(clean_dsn(), 'morrisville', etl_cleanup.CLEAN_TABLE_DDL, lambda cur: copy_dataframe(cur, 'morrisville', df_clean))
+    return df_clean
+
+
+# stage 3: merge the morrisville incidents and the ones of the other cities in sources.py into the rows of tbl_crimes
+def run_merge(df_clean, checkpoint, event):
+    if df_clean is None:
+        instrumentation.enter('extract')
+        df_clean = read_checkpoint(merged_dsn(), 'morrisville', sources.MORRISVILLE_COLUMNS)
+    instrumentation.enter('transform')
+    df_clean = df_clean[pd.to_datetime(df_clean['occurred']) >= sources.MORRISVILLE_START]
+    frames = [sources.MORRISVILLE.map(df_clean)]
+
+    instrumentation.enter('extract')
+    for source in sources.SOURCES:
+        if source is sources.MORRISVILLE:
+            continue
+        for chunk in source.read():
+            instrumentation.enter('transform')
+            frames.append(source.map(chunk))
+            instrumentation.enter('extract')
+    instrumentation.enter('transform')
+
+    #delete when date is missing, the incident ids are numbered like the serial column of tbl_crimes
+    df_crimes = pd.concat(frames, ignore_index=True)
+    df_crimes = df_crimes[df_crimes['rounded_time'].notna()].reset_index(drop=True)
+    df_crimes.insert(0, 'incident_id', range(1, len(df_crimes) + 1))
+    instrumentation.count(rows_in=sum(len(frame) for frame in frames), rows_out=len(df_crimes))
+    if checkpoint:
+        instrumentation.enter('load')
+        # the merge stage of load_dwh.py doesn't know these rows, its next run loads all sources again
+        def write_merged(cur):
+            for source in sources.SOURCES:
+                reset_stage(cur, load_dwh.HASH_STAGE + source.name)
+            copy_dataframe(cur, 'tbl_crimes', df_crimes)
+            # the serial continues after the written ids, so that the next run of load_dwh.py doesn't reuse them
+            cur.execute("SELECT setval(pg_get_serial_sequence('tbl_crimes', 'incident_id'), coalesce(max(incident_id), 0) + 1, false) FROM tbl_crimes;")
+        write_checkpoint(merged_dsn(), 'tbl_crimes', load_dwh.create_tbl_crimes, write_merged)
+    return df_crimes
+
+
+# stage 4: build the star schema from the merged incidents
+def run_dwh(df_crimes, checkpoint, event):
+    instrumentation.enter('connect')
+    conn = acquire(dwh_dsn())
+    try:
+        with conn.cursor() as cur:
+            instrumentation.enter('post_sql')
+            create_dwh.create_star_schema(cur, event.get('fact_layout'))
+            conn.commit()
+            # the pipeline doesn't compare the incidents by hash and the ids of its merged frame are numbered anew by every
+            # run, so they can't be matched with the loaded facts and the fact table is always rebuilt ('fact_mode' is only checked)
+            create_dwh.check_fact_mode(cur, event.get('fact_mode', 'incremental'))
+            fact_mode = 'full'
+            reset_stage(cur, create_dwh.HASH_STAGE)
+            if df_crimes is None:
+                source_conn = acquire(merged_dsn())
+                source_conn.autocommit = True
+                try:
+                    result = create_dwh.build_star_schema_python(source_conn, cur, fact_mode)
+                finally:
+                    release(source_conn)
+            else:
+                df_facts = df_crimes[create_dwh.FACT_SOURCE_COLUMNS]
+                chunks = (df_facts.iloc[start:start + CHUNK_SIZE] for start in range(0, len(df_facts), CHUNK_SIZE))
+                result = create_dwh.load_facts(cur, chunks, fact_mode)
+            # the loaded incidents get an empty hash, so the next run of create_dwh replaces all of them and deletes the
+            # ones that are not in tbl_crimes
+            instrumentation.enter('post_sql')
+            cur.execute("INSERT INTO etl_hashes (stage, key, record_hash) SELECT %s, incident_id::text, '' FROM factless_fact WHERE incident_id IS NOT NULL;", (create_dwh.HASH_STAGE,))
+        conn.commit()
+    except (psycopg2.Error, ValueError):
+        conn.rollback()
+        raise
+    finally:
+        release(conn)
+    result['fact_mode'] = fact_mode
+    return result
+
+
+# stage 5: the weather dimension doesn't depend on the crime data, so the lambda function is run as it is
+def run_weather(data, checkpoint, event):
+    return weather_dwh.lambda_handler(event, None)
+
+
+# stage 6: refresh the pre-aggregated views of the dashboards once the facts and the weather are loaded
+def run_aggregates(data, checkpoint, event):
+    return dwh_aggregates.lambda_handler(event, None)
+
+
+STAGE_FUNCTIONS = {'extract': run_extract, 'clean': run_clean, 'merge': run_merge, 'dwh': run_dwh, 'weather': run_weather, 'aggregates': run_aggregates}
+
+
+# run the stages from start to end, the stages in checkpoints write their output table
+def run_pipeline(start='extract', end='aggregates', checkpoints=(), event=None):
+    event = event or {}
+    stages = STAGES[STAGES.index(start):STAGES.index(end) + 1]
+    result = {'stages': {}}
+    data = None
+    for stage in stages:
+        start_time = time.perf_counter()
+        # every stage is recorded as its own run, the lambda functions that are called as they are record their own metrics
+        stage_run = instrumentation.start_run('pipeline_' + stage)
+        try:
+            data = STAGE_FUNCTIONS[stage](data, stage in checkpoints, event)
+        except (psycopg2.Error, requests.RequestException, ValueError) as e:
+            print(f"An error occurred in stage {stage}: {str(e)}")
+            result['failed_stage'] = stage
+            instrumentation.finish_run(stage_run)
+            break
+        stage_metrics = instrumentation.finish_run(stage_run)
+        stage_result = {'seconds': round(time.perf_counter() - start_time, 3)}
+        if isinstance(data, pd.DataFrame):
+            stage_result['rows'] = len(data)
+        else:
+            stage_result.update(data)
+        stage_result.setdefault('metrics', stage_metrics)
+        result['stages'][stage] = stage_result
+        print(f"Stage {stage}: {stage_result}")
+    return result
+
+
+def lambda_handler(event, context):
+    event = event or {}
+    result = run_pipeline(event.get('start', STAGES[0]), event.get('end', STAGES[-1]), set(event.get('checkpoints', [])), event)
+    result['connections'] = connect_metrics()
+    return result
@@ -0,0 +1,134 @@
+# the cities whose crime data is merged into tbl_crimes by load_dwh.py. Every city is a CitySource that declares its database,
+# the query of its incidents and the vectorized mapping of a chunk to the columns of tbl_crimes. A new town is added with
+# its mapping in transforms.py and an entry in SOURCES, load_dwh.py gives it its own loader thread and partition of tbl_crimes
+
+import os
+import config
+from etl_db import CHUNK_SIZE, acquire, batches, make_dsn, read_chunks, read_hashes, release
+import instrumentation
+import landing_zone
+from transforms import map_cary, map_morrisville
+
+
+# columns of the sources that are used for the merge
+MORRISVILLE_COLUMNS = ['occurred', 'rounded_timestamp', 'weekday', 'offense', 'street', 'city', 'subdivision', 'district', 'latitude', 'longitude']
+CARY_COLUMNS = ['date_from', 'from_time', 'from_time_rounded', 'crimeday', 'crime_type', 'geocode', 'subdivisn_id', 'district', 'lat', 'lon']
+# first day of the morrisville incidents that are merged
+MORRISVILLE_START = '2021-01-01'
+# the cary incidents have no id, they are keyed by the hash of the row and a number for rows that are the same
+CARY_KEY = "md5(c::text) || '-' || row_number() OVER (PARTITION BY md5(c::text))"
+# share of changed incidents above which the whole source is read once instead of querying the changed keys batch by batch
+FULL_READ_SHARE = float(os.environ.get('FULL_READ_SHARE', 0.5))
+
+
+# connection string from the environment variables of the endpoint, database, user and password of a source
+def database(*variables):
+    return lambda: make_dsn(*config.require(*variables))
+
+
+# connection strings of the morrisville database (the merged table is written there) and of the cary database
+morrisville_dsn = database('MORR_ENDPOINT', 'MORR_DB', 'OV_USERNAME', 'OV_PASSWORD')
+cary_dsn = database('CAR_ENDPOINT', 'CAR_DB', 'AS_USERNAME', 'AS_PASSWORD')
+
+
+# read the chunks of a query on its own connection
+def read_database(dsn, query, params=None):
+    conn = acquire(dsn)
+    try:
+        yield from read_chunks(conn, query, params)
+    finally:
+        release(conn)
+
+
+# a city that is merged into tbl_crimes. dsn returns the connection string of its database, query selects its incidents
+# with a column source_key that identifies an incident and a column record_hash that changes with its content, and
+# mapping turns a chunk of the query into the columns of tbl_crimes. key_type is the SQL type of source_key, so that the
+# filter on the changed keys can use an index of the source table. A key that is computed over the whole table (e.g. with
+# a window function) can't be filtered in the database (key_filter=False), its changed incidents are taken from one read
+# of the whole source
+class CitySource:
+    # the incidents have hashes, so only the new and changed ones are loaded
+    tracked = True
+
+    def __init__(self, name, dsn, query, mapping, key_type='text', key_filter=True):
+        self.name = name
+        self.dsn = dsn
+        self.query = query
+        self.mapping = mapping
+        self.key_type = key_type
+        self.key_filter = key_filter
+
+    # the hashes of the incidents keyed by their source_key
+    def read_hashes(self):
+        conn = acquire(self.dsn())
+        conn.autocommit = True
+        try:
+            return read_hashes(conn, "SELECT source_key, record_hash FROM ({}) source WHERE source_key IS NOT NULL;".format(self.query))
+        finally:
+            release(conn)
+
+    # the incidents with the given keys chunk by chunk, None reads all of them
+    def read(self, keys=None):
+        query = "SELECT * FROM ({}) source WHERE source_key IS NOT NULL".format(self.query)
+        if keys is None:
+            return read_database(self.dsn(), query + ";")
+        return read_database(self.dsn(), query + " AND source_key = ANY(%s::{}[]);".format(self.key_type), (list(keys),))
+
+    # the incidents with the given keys out of total incidents chunk by chunk. Without key filter or when most incidents
+    # changed, the source is read once and the chunks keep the changed rows, otherwise the keys are queried batch by batch
+    def read_changed(self, keys, total):
+        if not keys:
+            return
+        if not self.key_filter or len(keys) > total * FULL_READ_SHARE:
+            wanted = set(keys)
+            for chunk in self.read():
+                chunk = chunk[chunk['source_key'].astype(str).isin(wanted)]
+                if len(chunk) > 0:
+                    yield chunk
+        else:
+            for part in batches(keys):
+                yield from self.read(part)
+
+    # the rows of tbl_crimes for a chunk of the source, with the key and hash of the source rows when the chunk has them
+    def map(self, chunk):
+        df_crimes = self.mapping(chunk)
+        df_crimes['source'] = self.name
+        if 'source_key' in chunk.columns:
+            df_crimes['source_key'] = chunk['source_key'].astype(str).values
+        if 'record_hash' in chunk.columns:
+            df_crimes['record_hash'] = chunk['record_hash'].values
+        return df_crimes
+
+
+# the cleaned morrisville incidents from the parquet files of the landing zone. They have no hashes, so all of them are
+# replaced by every run
+class LandingZoneSource(CitySource):
+    tracked = False
+
+    def __init__(self, source, root):
+        super().__init__(source.name, source.dsn, source.query, source.mapping)
+        self.root = root
+
+    # only the partitions and columns that are merged are read
+    def read(self, keys=None):
+        import pandas as pd
+        start = pd.Timestamp(MORRISVILLE_START)
+        df_mor = landing_zone.read_partitions('clean', columns=MORRISVILLE_COLUMNS, since=(start.year, start.month), root=self.root)
+        df_mor = df_mor[pd.to_datetime(df_mor['occurred']) >= start]
+        instrumentation.count(rows_out=len(df_mor))
+        yield from landing_zone.iter_chunks(df_mor, CHUNK_SIZE)
+
+
+MORRISVILLE = CitySource(
+    'morrisville', morrisville_dsn,
+    "SELECT {}, id AS source_key, record_hash FROM morrisville WHERE occurred >= '{}' AND id IS NOT NULL".format(', '.join(MORRISVILLE_COLUMNS), MORRISVILLE_START),
+    map_morrisville, key_type='int'
+)
+CARY = CitySource(
+    'cary', cary_dsn,
+    "SELECT *, source_key AS record_hash FROM (SELECT {}, {} AS source_key FROM clean_data_gold_2 c) cary".format(', '.join('c.' + column for column in CARY_COLUMNS), CARY_KEY),
+    map_cary, key_filter=False
+)
+
+# the cities that are merged, the name is the value of tbl_crimes.source and names the partition of the city
+SOURCES = [MORRISVILLE, CARY]
@@ -0,0 +1,122 @@
+# tests of the star schema in create_dwh.py against a PostgreSQL database. They run in a schema of their own in a transaction
+# that is rolled back and are skipped without TEST_DSN, e.g.: TEST_DSN="host=localhost dbname=test user=postgres" python -m pytest -q
+
+import datetime
+import os
+import uuid
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+import create_dwh
+from etl_db import HASHES_DDL, save_hashes, stored_hashes
+
+
+@pytest.fixture
+def dwh_cur():
+    if not os.environ.get('TEST_DSN'):
+        pytest.skip("TEST_DSN is not set")
+    conn = psycopg2.connect(os.environ['TEST_DSN'])
+    schema = 'test_{}'.format(uuid.uuid4().hex[:12])
+    cur = conn.cursor()
+    cur.execute("CREATE SCHEMA {0}; SET search_path TO {0};".format(schema))
+    try:
+        yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+# write one fact through new_facts like the fact load does
+def write_fact(cur, incident_id, date_fk):
+    create_dwh.create_new_facts(cur)
+    cur.execute("INSERT INTO new_facts (incident_id, date_fk) VALUES (%s, %s);", (incident_id, date_fk))
+    return create_dwh.write_facts(cur, 'incremental')
+
+
+def test_partitioned_fact_layout(dwh_cur):
+    assert create_dwh.create_star_schema(dwh_cur, 'partitioned') == 'partitioned'
+    assert create_dwh.fact_table_layout(dwh_cur) == 'partitioned'
+    # a second run keeps the layout
+    assert create_dwh.create_star_schema(dwh_cur) == 'partitioned'
+    assert write_fact(dwh_cur, 1, datetime.datetime(2023, 5, 1, 10)) == 1
+    dwh_cur.execute("SELECT tableoid::regclass::text FROM factless_fact;")
+    assert dwh_cur.fetchone()[0] == 'factless_fact_2023_05'
+
+
+def test_change_plain_to_partitioned(dwh_cur):
+    assert create_dwh.create_star_schema(dwh_cur) == 'plain'
+    write_fact(dwh_cur, 1, datetime.datetime(2023, 5, 1, 10))
+    dwh_cur.execute(HASHES_DDL)
+    save_hashes(dwh_cur, create_dwh.HASH_STAGE, {'1': 'a'}, ['1'], [])
+    assert create_dwh.create_star_schema(dwh_cur, 'partitioned') == 'partitioned'
+    assert create_dwh.fact_table_layout(dwh_cur) == 'partitioned'
+    # the dropped facts are loaded again by the next run
+    assert stored_hashes(dwh_cur, create_dwh.HASH_STAGE) == {}
+
+
+# an empty fact table with stored hashes is rebuilt instead of skipping all incidents
+def test_check_fact_mode_of_empty_table(dwh_cur):
+    create_dwh.create_star_schema(dwh_cur)
+    assert create_dwh.check_fact_mode(dwh_cur, 'incremental') == 'incremental'
+    save_hashes(dwh_cur, create_dwh.HASH_STAGE, {'1': 'a'}, ['1'], [])
+    assert create_dwh.check_fact_mode(dwh_cur, 'incremental') == 'full'
+    assert stored_hashes(dwh_cur, create_dwh.HASH_STAGE) == {}
+
+
+# the sql engine keys the locations with the same cells as the python engine, incidents without coordinates have none
+def test_geohash_parity(dwh_cur):
+    pd = pytest.importorskip('pandas')
+    from transforms import geohash
+    create_dwh.create_star_schema(dwh_cur)
+    latitude = [35.7915, 35.8213, -90.0, 90.0, 0.0, None, 35.8, None]
+    longitude = [-78.7811, -78.8256, -180.0, 180.0, 0.0, -78.8, None, None]
+    expected = geohash(pd.Series(latitude, dtype=float), pd.Series(longitude, dtype=float), create_dwh.LOCATION_PRECISION)
+    dwh_cur.execute("SELECT geohash_encode(lat, lon, %s) FROM unnest(%s::float[], %s::float[]) WITH ORDINALITY AS c(lat, lon, n) ORDER BY n;",
+                    (create_dwh.LOCATION_PRECISION, latitude, longitude))
+    assert [row[0] for row in dwh_cur.fetchall()] == expected
+    assert expected[5:] == [None, None, None]
+
+
+# both engines build the same dimensions and facts from the same incidents
+def test_engine_parity(dwh_cur):
+    pytest.importorskip('pandas')
+    incidents = [
+        (1, '2023-05-01 10:00', 'LARCENY', 35.7915, -78.7811),
+        (2, '2023-05-01 11:00', 'LARCENY', 35.79151, -78.78111),
+        (3, '2023-05-02 12:00', 'ASSAULT', 35.8213, -78.8256),
+        (4, '2023-05-02 13:00', 'FRAUD', None, None)
+    ]
+    built = {}
+    for engine in ('sql', 'python'):
+        dwh_cur.execute("CREATE SCHEMA parity_{0}; SET search_path TO parity_{0};".format(engine))
+        dwh_cur.execute("CREATE TABLE tbl_crimes (incident_id int, datetime timestamp, rounded_time timestamp, weekday text, crime_type text, street text, city text, subdivision text, district text, latitude float, longitude float);")
+        dwh_cur.executemany("INSERT INTO tbl_crimes (incident_id, datetime, rounded_time, crime_type, city, latitude, longitude) VALUES (%s, %s, %s, %s, 'MORRISVILLE', %s, %s);",
+                            [(incident_id, time, time, crime_type, latitude, longitude) for incident_id, time, crime_type, latitude, longitude in incidents])
+        create_dwh.create_star_schema(dwh_cur)
+        if engine == 'sql':
+            create_dwh.build_star_schema_sql(dwh_cur, dwh_cur, 'full')
+        else:
+            create_dwh.build_star_schema_python(dwh_cur.connection, dwh_cur, 'full')
+        dwh_cur.execute("SELECT f.incident_id, c.crime_type, f.date_fk, l.geohash, l.city FROM factless_fact f LEFT JOIN dim_crime c ON c.crime_id = f.crime_fk "
+                        "LEFT JOIN dim_location l ON l.location_id = f.location_fk ORDER BY f.incident_id;")
+        built[engine] = dwh_cur.fetchall()
+    assert built['sql'] == built['python']
+    # the first two incidents share a cell, the one without coordinates has the location of its address
+    assert built['sql'][0][3] == built['sql'][1][3]
+    assert built['sql'][3][3:] == (None, 'MORRISVILLE')
+
+
+# locations without coordinates of older runs are kept and keyed by their address, their incidents are loaded again
+def test_address_locations_of_older_runs(dwh_cur):
+    create_dwh.create_star_schema(dwh_cur)
+    dwh_cur.execute("DROP INDEX dim_location_address_key;")
+    dwh_cur.execute("INSERT INTO dim_location (location_id, city, district, geohash) VALUES (101, 'CARY', 'D1', '00000000'), (102, 'CARY', 'D1', NULL), (103, 'APEX', NULL, NULL);")
+    dwh_cur.execute("INSERT INTO factless_fact (incident_id, location_fk) VALUES (1, 101), (2, 102), (3, 103), (4, NULL);")
+    dwh_cur.execute(HASHES_DDL)
+    save_hashes(dwh_cur, create_dwh.HASH_STAGE, {'1': 'a', '2': 'b', '3': 'c', '4': 'd', '5': 'e'}, ['1', '2', '3', '4', '5'], [])
+    create_dwh.create_star_schema(dwh_cur)
+    dwh_cur.execute("SELECT location_id, city, geohash FROM dim_location ORDER BY location_id;")
+    assert dwh_cur.fetchall() == [(101, 'CARY', None), (103, 'APEX', None)]
+    dwh_cur.execute("SELECT incident_id, location_fk FROM factless_fact ORDER BY incident_id;")
+    assert dwh_cur.fetchall() == [(1, 101), (2, 101), (3, 103), (4, None)]
+    assert stored_hashes(dwh_cur, create_dwh.HASH_STAGE) == {'5': 'e'}
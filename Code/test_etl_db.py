@@ -0,0 +1,92 @@
+# tests of the connection pool in etl_db.py with a fake psycopg2.connect, they need no database: python -m pytest -q
+
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+import etl_db
+
+
+# connection that counts its rollbacks and can be broken, so that its health check fails
+class FakeConnection:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.closed = False
+        self.broken = False
+        self.autocommit = True
+        self.rollbacks = 0
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.rollbacks += 1
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query, vars=None):
+        if self.conn.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    connections = []
+    def fake_connect(dsn, **kwargs):
+        connections.append(FakeConnection(dsn))
+        return connections[-1]
+    monkeypatch.setattr(etl_db.psycopg2, 'connect', fake_connect)
+    monkeypatch.setattr(etl_db, '_idle_connections', {})
+    monkeypatch.setattr(etl_db, '_connect_metrics', {'connects': 0, 'reuses': 0, 'failed_health_checks': 0, 'connect_seconds': 0.0, 'last_connect_seconds': None})
+    return connections
+
+
+def test_released_connection_is_reused(connect):
+    conn = etl_db.acquire('dsn_a')
+    etl_db.release(conn)
+    # the open transaction is rolled back when the connection is released
+    assert conn.rollbacks == 1
+    assert etl_db.acquire('dsn_a') is conn
+    assert conn.autocommit is False
+    # another connection string gets its own connection
+    assert etl_db.acquire('dsn_b') is not conn
+    metrics = etl_db.connect_metrics()
+    assert (metrics['connects'], metrics['reuses'], metrics['failed_health_checks']) == (2, 1, 0)
+    assert metrics['last_connect_seconds'] is not None
+
+
+def test_closed_connection_is_replaced(connect):
+    conn = etl_db.acquire('dsn_a')
+    etl_db.release(conn)
+    conn.closed = True
+    replacement = etl_db.acquire('dsn_a')
+    assert replacement is not conn
+    metrics = etl_db.connect_metrics()
+    assert (metrics['connects'], metrics['reuses'], metrics['failed_health_checks']) == (2, 0, 1)
+
+
+def test_broken_connection_is_replaced(connect):
+    conn = etl_db.acquire('dsn_a')
+    etl_db.release(conn)
+    conn.broken = True
+    replacement = etl_db.acquire('dsn_a')
+    assert replacement is not conn and conn.closed
+    assert etl_db.connect_metrics()['failed_health_checks'] == 1
+    # a connection that can't be rolled back is closed instead of going back to the pool
+    replacement.broken = True
+    etl_db.release(replacement)
+    assert replacement.closed
+    assert etl_db.acquire('dsn_a') is connect[-1] and len(connect) == 3
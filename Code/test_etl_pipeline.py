@@ -0,0 +1,140 @@
+# tests of the raw load in etl_pipeline.py. The extraction is tested against a local HTTP server that serves a recorded
+# export. The database tests run in a schema of their own in a transaction that is rolled back and are skipped without
+# TEST_DSN, e.g.: TEST_DSN="host=localhost dbname=test user=postgres" python -m pytest -q
+
+import hashlib
+import http.server
+import json
+import os
+import threading
+import urllib.parse
+import uuid
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+import etl_pipeline
+from etl_db import LOAD_STATE_DDL
+
+
+@pytest.fixture
+def raw_cur():
+    if not os.environ.get('TEST_DSN'):
+        pytest.skip("TEST_DSN is not set")
+    conn = psycopg2.connect(os.environ['TEST_DSN'])
+    schema = 'test_{}'.format(uuid.uuid4().hex[:12])
+    cur = conn.cursor()
+    cur.execute("CREATE SCHEMA {0}; SET search_path TO {0};".format(schema))
+    cur.execute(etl_pipeline.RAW_TABLE_DDL)
+    try:
+        yield cur
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+# a record of the API with the fields of the raw table
+def api_record(inci_id, date_rept, offense='LARCENY'):
+    return {'date_rept': date_rept, 'date_occu': date_rept, 'dow1': 'Monday', 'monthstamp': 'May', 'yearstamp': 2023, 'inci_id': inci_id,
+            'offense': offense, 'street': 'MAIN ST', 'city': 'MORRISVILLE', 'area': {'lat': 35.82, 'lon': -78.83}}
+
+
+# a recorded export of the API: a street with a tab and a non-ASCII character, and fields that are missing
+RECORDED = [
+    api_record(101, '2023-05-01T10:20:00+00:00'),
+    dict(api_record(102, '2023-05-02T23:45:00+00:00', 'ASSAULT'), street='CHAPEL HILL\tRD', neighborhd='PARC CITÉ', area=None),
+    api_record(103, '2023-05-03T08:00:00+00:00', 'FRAUD')
+]
+
+
+# serves RECORDED as the json export and page by page as the records API
+class RecordedApi(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.endswith('/exports/json'):
+            body = json.dumps(RECORDED, ensure_ascii=False).encode('utf-8')
+        elif url.path.endswith('/records'):
+            offset, limit = int(query['offset'][0]), int(query['limit'][0])
+            body = json.dumps({'total_count': len(RECORDED), 'results': RECORDED[offset:offset + limit]}, ensure_ascii=False).encode('utf-8')
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api_url():
+    server = http.server.HTTPServer(('127.0.0.1', 0), RecordedApi)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/api/explore/v2.1/catalog/datasets/pd_incident_report'.format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# cursor that keeps what is copied instead of sending it to a database
+class CopyCursor:
+    def copy_expert(self, sql, file):
+        self.sql = sql
+        self.data = file.read()
+
+
+def test_stream_export(api_url):
+    # chunks of a few bytes split the records and the multi-byte character
+    assert list(etl_pipeline.stream_export(api_url, chunk_size=7)) == RECORDED
+
+
+def test_page_records(api_url):
+    assert list(etl_pipeline.page_records(api_url, page_size=2)) == RECORDED
+    # a resumed load continues after the records it has loaded already
+    assert list(etl_pipeline.page_records(api_url, page_size=2, offset=1)) == RECORDED[1:]
+
+
+def test_copy_records(api_url):
+    cur = CopyCursor()
+    records = list(etl_pipeline.extract_records(api_url, 'export'))
+    assert etl_pipeline.copy_records(cur, 'morrisville_staging', records) == 3
+    assert cur.sql == "COPY morrisville_staging ({}) FROM STDIN".format(', '.join(etl_pipeline.COPY_COLUMNS))
+    lines = cur.data.split('\n')
+    assert lines[-1] == '' and len(lines) == 4
+    # the fields in the order of the raw table, the tab of the street is escaped and missing fields are NULL
+    expected = ('2023-05-02T23:45:00+00:00\t2023-05-02T23:45:00+00:00\tMonday\tMay\t2023\t102\tASSAULT\tCHAPEL HILL\\tRD\tMORRISVILLE\t\\N\t\\N\t'
+                'PARC CITÉ\t\\N\t\\N\t\\N\t\\N\t\\N\tnull')
+    fields, record_hash = lines[1].rsplit('\t', 1)
+    assert fields == expected
+    # the hash is the md5 of the copied fields, so it only changes with them
+    assert record_hash == hashlib.md5(expected.encode('utf-8')).hexdigest()
+    assert len({line.rsplit('\t', 1)[1] for line in lines[:3]}) == 3
+    # the area is stored as json with sorted keys
+    assert lines[0].rsplit('\t', 2)[1] == '{"lat": 35.82, "lon": -78.83}'
+
+
+# a table that was bulk-loaded before the upsert keeps the latest report of every incident
+def test_create_id_key_removes_duplicates(raw_cur):
+    raw_cur.execute("INSERT INTO morrisville (id, reported, offense) VALUES (1, '2023-05-01', 'OLD'), (1, '2023-05-02', 'NEW'), (2, '2023-05-01', 'ONLY'), (NULL, '2023-05-01', 'NO ID');")
+    assert etl_pipeline.create_id_key(raw_cur) == 1
+    raw_cur.execute("SELECT id, offense FROM morrisville ORDER BY id;")
+    assert raw_cur.fetchall() == [(1, 'NEW'), (2, 'ONLY'), (None, 'NO ID')]
+    # the index exists, a second run leaves the table alone
+    assert etl_pipeline.create_id_key(raw_cur) == 0
+
+
+# records are upserted by incident id, records without id are skipped instead of piling up
+def test_load_batch_upserts_by_id(raw_cur):
+    etl_pipeline.create_id_key(raw_cur)
+    raw_cur.execute(LOAD_STATE_DDL)
+    batch = [api_record(1, '2023-05-01T10:00:00'), api_record(1, '2023-05-02T10:00:00', 'ASSAULT'), api_record(None, '2023-05-01T11:00:00')]
+    assert etl_pipeline.load_batch(batch)(raw_cur) == 1
+    # the same batch again doesn't change anything
+    assert etl_pipeline.load_batch(batch)(raw_cur) == 0
+    raw_cur.execute("SELECT id, offense FROM morrisville;")
+    assert raw_cur.fetchall() == [(1, 'ASSAULT')]
@@ -0,0 +1,60 @@
+# tests of the transformations in transforms.py, they need pandas and numpy but no database: python -m pytest -q
+
+import numpy as np
+import pandas as pd
+from columns import TBL_CRIMES_COLUMNS
+from transforms import map_cary, map_morrisville, normalize_coordinates
+
+
+def test_normalize_coordinates_swaps_negative_latitude():
+    latitude = pd.Series([-78.85, 35.82, np.nan])
+    longitude = pd.Series([35.81, -78.83, np.nan])
+    latitude, longitude = normalize_coordinates(latitude, longitude)
+    assert latitude.tolist()[:2] == [35.81, 35.82]
+    assert longitude.tolist()[:2] == [-78.85, -78.83]
+    # missing coordinates stay missing
+    assert np.isnan(latitude.iloc[2]) and np.isnan(longitude.iloc[2])
+
+
+def test_map_morrisville():
+    df_mor = pd.DataFrame({
+        'occurred': ['2023-05-01 10:20:00', '2023-05-02 23:45:00'],
+        'rounded_timestamp': ['2023-05-01 10:00:00', '2023-05-03 00:00:00'],
+        'weekday': ['Monday', 'Tuesday'],
+        'offense': ['LARCENY', 'ASSAULT'],
+        'street': ['MAIN ST', None],
+        'city': ['MORRISVILLE', 'MORRISVILLE'],
+        'subdivision': [None, 'PARK'],
+        'district': ['D1', 'D2'],
+        'latitude': [-78.85, 35.82],
+        'longitude': [35.81, -78.83]
+    })
+    df_crimes = map_morrisville(df_mor)
+    assert list(df_crimes.columns) == TBL_CRIMES_COLUMNS
+    assert df_crimes['crime_type'].tolist() == ['LARCENY', 'ASSAULT']
+    assert df_crimes['rounded_time'].tolist() == [pd.Timestamp('2023-05-01 10:00'), pd.Timestamp('2023-05-03 00:00')]
+    # the swapped coordinates of the first incident are put the right way round
+    assert df_crimes['latitude'].tolist() == [35.81, 35.82]
+    assert df_crimes['longitude'].tolist() == [-78.85, -78.83]
+
+
+def test_map_cary_with_missing_time():
+    df_car = pd.DataFrame({
+        'date_from': ['2023-05-01', '2023-05-02'],
+        'from_time': ['10:20:00', None],
+        'from_time_rounded': ['10:00:00', '23:00:00'],
+        'crimeday': ['MONDAY', 'TUESDAY'],
+        'crime_type': ['FRAUD', 'THEFT'],
+        'geocode': ['HIGH HOUSE RD', 'KILDAIRE FARM RD'],
+        'subdivisn_id': [None, 'S2'],
+        'district': ['D3', 'D4'],
+        'lat': [35.79, 35.75],
+        'lon': [-78.78, -78.80]
+    })
+    df_crimes = map_cary(df_car)
+    assert list(df_crimes.columns) == TBL_CRIMES_COLUMNS
+    assert df_crimes['datetime'].iloc[0] == pd.Timestamp('2023-05-01 10:20')
+    # a missing time gives a missing timestamp instead of an error, the rounded time is still set
+    assert pd.isna(df_crimes['datetime'].iloc[1])
+    assert df_crimes['rounded_time'].iloc[1] == pd.Timestamp('2023-05-02 23:00')
+    assert df_crimes['city'].tolist() == ['CARY', 'CARY']
@@ -0,0 +1,142 @@
+# transformations of the crime and weather data that don't need a database or any configuration, they are used by the
+# lambda functions and by the benchmarks (benchmark.py) and work on dataframes only
+
+import numpy as np
+import pandas as pd
+from columns import API_FIELDS, CITY_ALIASES, CLEAN_COLUMNS, EXCLUDED_CITIES, RAW_TABLE_COLUMNS, RAW_WEATHER_COLUMNS, TBL_CRIMES_COLUMNS, TRACKING_COLUMNS, WEATHER_COLUMNS
+
+
+# the API records as a dataframe with the columns of the raw table, the timestamps are parsed like postgres does it (the UTC offset is ignored)
+def raw_frame(records):
+    df = pd.DataFrame.from_records(records, columns=API_FIELDS)
+    df.columns = RAW_TABLE_COLUMNS
+    for column in ('reported', 'occurred'):
+        df[column] = pd.to_datetime(df[column].astype('string').str.slice(0, 19), errors='coerce')
+    return df
+
+
+# round timestamps to the nearest full hour (minute < 30 down, otherwise up) so that they can be joined with the hourly weather data
+def round_half_hour(timestamps):
+    timestamps = pd.to_datetime(timestamps)
+    hours = timestamps.dt.floor('h')
+    return hours.where(timestamps.dt.minute < 30, hours + pd.Timedelta(hours=1))
+
+
+# all transformations of the raw data, done column-wise on a dataframe (one chunk of the raw table)
+def clean_raw(df):
+    df = df.copy()
+
+    # unpack latitude and longitude from the area dicts (the area can be missing)
+    areas = pd.DataFrame.from_records([area if isinstance(area, dict) else {} for area in df['area']], index=df.index, columns=['lat', 'lon'])
+    df['latitude'] = areas['lat'].astype(float)
+    df['longitude'] = areas['lon'].astype(float)
+
+    # timestamp rounded to full hours for the join with the weather dataset
+    df['occurred'] = pd.to_datetime(df['occurred'])
+    df['rounded_timestamp'] = round_half_hour(df['occurred'])
+
+    # canonical city names
+    df['city'] = df['city'].replace(CITY_ALIASES)
+
+    # remove entries with missing timestamp, missing city or from other towns
+    keep = df['city'].notna() & ~df['city'].isin(EXCLUDED_CITIES) & df['rounded_timestamp'].notna()
+    # id and hash of the raw record are kept if they were read
+    df = df.loc[keep, CLEAN_COLUMNS + [column for column in TRACKING_COLUMNS if column in df.columns]]
+    df['year'] = df['year'].astype('Int64')
+    return df
+
+
+# the area of the morrisville export has latitude and longitude the other way round. In the Triangle area the latitude
+# is positive and the longitude negative, so the two values are swapped wherever the latitude is negative
+def normalize_coordinates(latitude, longitude):
+    swapped = latitude < 0
+    return latitude.where(~swapped, longitude), longitude.where(~swapped, latitude)
+
+
+# characters of the geohash, every character encodes 5 bits
+GEOHASH_BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+# default number of characters of the geohash of dim_location, 8 characters are a cell of about 38 x 19 m
+GEOHASH_PRECISION = 8
+
+
+# geohash of every pair of coordinates with the given number of characters, None if a coordinate is missing. The coordinates
+# are snapped to the cells of the grid column-wise and the bits of both cell numbers are interleaved (longitude first),
+# the same arithmetic as the geohash_encode function of the DWH so that both engines get the same cells
+def geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    latitude = np.asarray(latitude, dtype=float)
+    longitude = np.asarray(longitude, dtype=float)
+    valid = ~(np.isnan(latitude) | np.isnan(longitude))
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    x = np.clip(np.floor((np.where(valid, longitude, 0) + 180) / 360 * 2.0 ** lon_bits), 0, 2 ** lon_bits - 1).astype(np.int64)
+    y = np.clip(np.floor((np.where(valid, latitude, 0) + 90) / 180 * 2.0 ** lat_bits), 0, 2 ** lat_bits - 1).astype(np.int64)
+    code = np.zeros(len(x), dtype=np.int64)
+    for i in range(bits):
+        if i % 2 == 0:
+            bit = (x >> (lon_bits - 1 - i // 2)) & 1
+        else:
+            bit = (y >> (lat_bits - 1 - i // 2)) & 1
+        code = (code << 1) | bit
+    hashes = GEOHASH_BASE32[(code >> (5 * (precision - 1))) & 31]
+    for k in range(1, precision):
+        hashes = np.char.add(hashes, GEOHASH_BASE32[(code >> (5 * (precision - 1 - k))) & 31])
+    return pd.Series(hashes, dtype=object).where(valid, None).tolist()
+
+
+# map the cleaned morrisville incidents to the columns of tbl_crimes
+def map_morrisville(df_mor):
+    latitude, longitude = normalize_coordinates(df_mor['latitude'].astype(float), df_mor['longitude'].astype(float))
+    return pd.DataFrame({
+        'datetime': pd.to_datetime(df_mor['occurred']),
+        'rounded_time': pd.to_datetime(df_mor['rounded_timestamp']),
+        'weekday': df_mor['weekday'],
+        'crime_type': df_mor['offense'],
+        'street': df_mor['street'],
+        'city': df_mor['city'],
+        'subdivision': df_mor['subdivision'],
+        'district': df_mor['district'],
+        'latitude': latitude,
+        'longitude': longitude
+    }, columns=TBL_CRIMES_COLUMNS)
+
+
+# map the cary incidents to the columns of tbl_crimes, date and time are combined into timestamps column-wise
+def map_cary(df_car):
+    date = pd.to_datetime(df_car['date_from'])
+    return pd.DataFrame({
+        'datetime': date + pd.to_timedelta(df_car['from_time'].astype(str), errors='coerce'),
+        'rounded_time': date + pd.to_timedelta(df_car['from_time_rounded'].astype(str), errors='coerce'),
+        'weekday': df_car['crimeday'],
+        'crime_type': df_car['crime_type'],
+        'street': df_car['geocode'],
+        'city': 'CARY',
+        'subdivision': df_car['subdivisn_id'],
+        'district': df_car['district'],
+        'latitude': df_car['lat'],
+        'longitude': df_car['lon']
+    }, columns=TBL_CRIMES_COLUMNS)
+
+
+# the raw hourly weather rows (columns of RAW_WEATHER_COLUMNS) with the column names of dim_weather
+def weather_frame(df_wea):
+    df_wea = df_wea[RAW_WEATHER_COLUMNS]
+    df_wea.columns = WEATHER_COLUMNS
+    return df_wea
+
+
+# the values of the dimensions for a chunk of incidents (columns of tbl_crimes), named like the columns of the dimension tables.
+# The locations are keyed by the geohash cell of their coordinates
+def dimension_frames(df, precision=GEOHASH_PRECISION):
+    return {
+        'dim_location': df[['city', 'street', 'subdivision', 'district', 'latitude', 'longitude']].assign(geohash=geohash(df['latitude'], df['longitude'], precision)),
+        'dim_crime': df[['crime_type']]
+    }
+
+
+# look up the natural keys of the frame in a map from natural key to surrogate key. Returns the natural key of every row,
+# whether it is complete (rows with a missing value can't be matched) and whether a complete key is missing in the map
+def match_keys(ids, frame, key_columns):
+    keys = list(zip(*(frame[column] for column in key_columns)))
+    valid = frame[key_columns].notna().all(axis=1).tolist()
+    missing = [is_valid and key not in ids for key, is_valid in zip(keys, valid)]
+    return keys, valid, missing
@@ -1,25 +1,60 @@
 # last function is adding the weather data to the dwh as a new dimension table
 
-import json
 import os
 import psycopg2
-import pandas as pd
-import numpy as np
-from psycopg2.extras import Json
+from psycopg2.extras import execute_values
+import config
+import instrumentation
+from columns import RAW_WEATHER_COLUMNS, WEATHER_COLUMNS
+from etl_db import acquire, connect_metrics, make_dsn, read_chunks, release
+from transforms import weather_frame
 
 
-DWH_ENDPOINT = os.environ['DWH_ENDPOINT']
-DWH_NAME = os.environ['DWH_NAME']
-OV_USERNAME = os.environ['OV_USERNAME']
-WEA_ENDPOINT = os.environ['WEA_ENDPOINT']
-WEA_DB = os.environ['WEA_DB']
-PJ_USERNAME = os.environ['PJ_USERNAME']
-PASSWORD = os.environ['PASSWORD']
+# first hour that is loaded into the DWH
+WEATHER_START = '2021-01-01'
+# number of fact IDs that are linked to the weather per transaction
+LINK_BATCH_SIZE = int(os.environ.get('LINK_BATCH_SIZE', 10000))
+
+
+# connection strings of the weather data lake and of the DWH
+def weather_dsn():
+    return make_dsn(*config.require('WEA_ENDPOINT', 'WEA_DB', 'PJ_USERNAME', 'PASSWORD'))
+
+
+def dwh_dsn():
+    return make_dsn(*config.require('DWH_ENDPOINT', 'DWH_NAME', 'OV_USERNAME', 'PASSWORD'))
+
+
+# insert the hourly rows in pages, hours that already exist are updated, returns the number of rows written
+def upsert_weather(cur, df, page_size=1000):
+    rows = df.astype(object).where(df.notna(), None).values.tolist()
+    updates = ', '.join("{0} = EXCLUDED.{0}".format(column) for column in WEATHER_COLUMNS if column != 'time')
+    query = "INSERT INTO dim_weather ({}) VALUES %s ON CONFLICT (time) DO UPDATE SET {};".format(', '.join(WEATHER_COLUMNS), updates)
+    execute_values(cur, query, rows, page_size=page_size)
+    return len(rows)
+
+
+# set weather_fk only for facts that don't have it yet, in ranges of fact IDs with one commit per range, returns the number of linked facts
+def link_weather(conn, cur, batch_size=LINK_BATCH_SIZE):
+    cur.execute("SELECT min(fact_id), max(fact_id) FROM factless_fact WHERE weather_fk IS NULL;")
+    first_id, last_id = cur.fetchone()
+    linked = 0
+    if first_id is None:
+        return linked
+    for batch_start in range(first_id, last_id + 1, batch_size):
+        cur.execute("UPDATE factless_fact SET weather_fk = dim_weather.weather_id FROM dim_weather WHERE factless_fact.fact_id >= %s AND factless_fact.fact_id < %s AND factless_fact.weather_fk IS NULL AND factless_fact.date_fk = dim_weather.time;", (batch_start, batch_start + batch_size))
+        linked += cur.rowcount
+        conn.commit()
+    return linked
+
 
 def lambda_handler(event, context):
+    run = instrumentation.start_run('weather_dwh')
+    
     #Connect to the weather database
+    run.enter('connect')
     try:
-        wea_conn = psycopg2.connect("host={} dbname={} user={} password={}".format(WEA_ENDPOINT, WEA_DB, PJ_USERNAME, PASSWORD))
+        wea_conn = acquire(weather_dsn())
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
         print(e)
@@ -32,7 +67,7 @@ def lambda_handler(event, context):
        
     # Connect to the dwh
     try:
-        dwh_conn = psycopg2.connect("host={} dbname={} user={} password={}".format(DWH_ENDPOINT, DWH_NAME, OV_USERNAME, PASSWORD))
+        dwh_conn = acquire(dwh_dsn())
     except psycopg2.Error as e:
         print("Error: Could not make connection to the Postgres database")
         print(e)
@@ -44,11 +79,12 @@ def lambda_handler(event, context):
         print(e)
         
 
-    #Auto commit
+    #Auto commit for the source, the DWH is written in transactions
     wea_conn.set_session(autocommit=True)
-    dwh_conn.set_session(autocommit=True)
+    dwh_conn.set_session(autocommit=False)
     
     #create the new dimension table inside the DWH and add the id column to the factless fact table
+    run.enter('post_sql')
     dwh_cur.execute("CREATE TABLE IF NOT EXISTS dim_weather (weather_id SERIAL PRIMARY KEY, time timestamp, temp float, humidity int, dew_point float, apparent_temp float, precipitation float, rain float, snowfall float, snow_depth float, weather_code int, cloud_cover int, wind_speed float, is_day int);")
     dwh_conn.commit()
 
@@ -56,70 +92,67 @@ def lambda_handler(event, context):
     dwh_conn.commit()
     
     
-    #Get the weather data from the datalake
-    try:
-        wea_cur.execute("SELECT * FROM weatherdataraw WHERE time >= '2021-01-01';")
-    except psycopg2.Error as e:
-        print(f"Error executing the query. Error: {e}")
+    # one row per hour, the unique index makes the lookups of the weather join index probes
+    dwh_cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS dim_weather_time_key ON dim_weather (time);")
+    dwh_conn.commit()
     
-    columns = [desc[0] for desc in wea_cur.description]
-    wea_data = wea_cur.fetchall()
-    df_wea = pd.DataFrame(wea_data, columns=columns)
-
-    #check if the data already exists in the dimension table, if yes get the ID
-    check_query_wea = "SELECT weather_id FROM dim_weather WHERE time = %s;"
+    # only the hours after the latest hour in the dimension are loaded
+    dwh_cur.execute("SELECT max(time) FROM dim_weather;")
+    latest_hour = dwh_cur.fetchone()[0]
+    
+    #Get the weather data from the datalake chunk by chunk
+    if latest_hour is None:
+        wea_query, wea_params = "SELECT {} FROM weatherdataraw WHERE time >= %s ORDER BY time;".format(', '.join(RAW_WEATHER_COLUMNS)), (WEATHER_START,)
+    else:
+        wea_query, wea_params = "SELECT {} FROM weatherdataraw WHERE time > %s ORDER BY time;".format(', '.join(RAW_WEATHER_COLUMNS)), (latest_hour,)
 
+    hours_added = 0
     try:
-        for index, row in df_wea.iterrows():
-            #this is the value used for the check of the existing entries defined above
-            check_values_wea = (row['time'],)
-            
-            # execute the check and get the existing IDs (if possible)
-            dwh_cur.execute(check_query_wea, check_values_wea)
-            existing_weather_id = dwh_cur.fetchone()
-        
-            if existing_weather_id is None:
-                
-                query = "INSERT INTO dim_weather (weather_id, time, temp, humidity, dew_point, apparent_temp, precipitation, rain, snowfall, snow_depth, weather_code, cloud_cover, wind_speed, is_day) VALUES (DEFAULT, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
-                values = (
-                    row['time'],
-                    row['temperature_2m'],
-                    row['relative_humidity_2m'],
-                    row['dew_point_2m'],
-                    row['apparent_temperature'],
-                    row['precipitation'],
-                    row['rain'],
-                    row['snowfall'],
-                    row['snow_depth'],
-                    row['weather_code'],
-                    row['cloud_cover'],
-                    row['wind_speed_10m'],
-                    row['is_day']
-                )
-                try:
-                    dwh_cur.execute(query, values)
-                except psycopg2.Error as e:
-                    print(f"An error occurred: {str(e)}")
-                    
-                dwh_conn.commit()
-                
+        for df_wea in run.iterate(read_chunks(wea_conn, wea_query, wea_params), 'extract'):
+            run.enter('transform')
+            df_wea = weather_frame(df_wea)
+            run.count(rows_in=len(df_wea), rows_out=len(df_wea))
+            run.enter('load')
+            upserted = upsert_weather(dwh_cur, df_wea)
+            run.count(rows_in=len(df_wea), rows_out=upserted)
+            hours_added += upserted
+        run.enter('post_sql')
         dwh_conn.commit()
-    except Exception as e:
-        print(f"Error writing fact table to PostgreSQL: {e}")
+    except psycopg2.Error as e:
+        dwh_conn.rollback()
+        hours_added = 0
+        print(f"Error writing weather dimension to PostgreSQL: {e}")
+    print(f"Added {hours_added} hours to dim_weather (previous latest hour: {latest_hour})")
     
-    update_query = "UPDATE factless_fact SET weather_fk = dim_weather.weather_id FROM dim_weather WHERE factless_fact.date_fk = dim_weather.time;"
-
+    # index for the time join, the weather foreign key and a partial index to find the facts that are not linked yet
+    run.enter('post_sql')
+    dwh_cur.execute("CREATE INDEX IF NOT EXISTS factless_fact_date_fk_idx ON factless_fact (date_fk);")
+    dwh_cur.execute("CREATE INDEX IF NOT EXISTS factless_fact_weather_fk_idx ON factless_fact (weather_fk);")
+    dwh_cur.execute("CREATE INDEX IF NOT EXISTS factless_fact_unlinked_idx ON factless_fact (fact_id) WHERE weather_fk IS NULL;")
+    dwh_conn.commit()
+    
+    # 'incremental' links only facts without weather_fk in bounded batches, 'full' updates every fact in one statement
+    link_mode = (event or {}).get('link_mode', 'incremental')
+    facts_linked = 0
     try:
-        dwh_cur.execute(update_query)
+        if link_mode == 'full':
+            dwh_cur.execute("UPDATE factless_fact SET weather_fk = dim_weather.weather_id FROM dim_weather WHERE factless_fact.date_fk = dim_weather.time;")
+            facts_linked = dwh_cur.rowcount
+        else:
+            facts_linked = link_weather(dwh_conn, dwh_cur, int((event or {}).get('batch_size', LINK_BATCH_SIZE)))
     except psycopg2.Error as e:
+        dwh_conn.rollback()
         print(f"An error occurred: {str(e)}")
 
     # Commit the changes
     dwh_conn.commit()
+    run.count(rows_out=facts_linked)
+    print(f"Linked {facts_linked} facts to dim_weather ({link_mode})")
     
     #close connection to the  database
     wea_cur.close()
-    wea_conn.close()
+    release(wea_conn)
     dwh_cur.close()
-    dwh_conn.close()
-    
+    release(dwh_conn)
+
+    return {'hours_added': hours_added, 'facts_linked': facts_linked, 'connections': connect_metrics(), 'metrics': instrumentation.finish_run(run)}